@@ -1,6 +1,7 @@
 from pathlib import Path
 import datetime
 import numpy
+import pandas
 import pickle
 
 
@@ -15,24 +16,65 @@ class Generator:
         with open(models_path / 'q.pickle', 'rb') as f:
             self._q = pickle.load(f)
 
+        self._bus_vectors = None
+        self._network_key = None
+
+    @property
+    def network(self):
+        return self._network
+
+    @network.setter
+    def network(self, network):
+        self._network = network
+        self.refresh()
+
+    def refresh(self):
+        """Recalculates per-bus net injections and voltage levels. Done
+        automatically when the network, or its bus, load or static generator
+        tables are replaced or resized, needs to be called explicitly if
+        their values are changed in place"""
+        self._bus_vectors = _get_bus_vectors(self._network)
+        self._network_key = _get_network_key(self._network)
+
     def generate(self, bus_id, meas_type):
+        return self.generate_batch([(bus_id, meas_type)])[0]
 
-        now = datetime.datetime.now()
-        vector = []
-        vector.extend(_get_season_vector(now))
-        vector.extend(_get_day_vector(now))
-        vector.extend(_get_time_vector(now))
-        vector.extend(_get_bus_vector(self._network, bus_id))
-        vector = numpy.array(vector)
-        vector = vector.reshape(1, -1)
-
-        if meas_type == 'p':
-            return self._p.predict(vector)[0]
-        elif meas_type == 'q':
-            return self._q.predict(vector)[0]
-        else:
+    def generate_batch(self, requests):
+        """Generates pseudomeasurements of multiple buses, predicting all
+        values of the same measurement type at once
+
+        Args:
+            requests: pairs of bus id and measurement type (``p`` or ``q``)
+
+        Returns:
+            List of generated values, in order of the requests"""
+        models = {'p': self._p, 'q': self._q}
+        if any(meas_type not in models for _, meas_type in requests):
             raise ValueError
 
+        now = datetime.datetime.now()
+        time_vector = []
+        time_vector.extend(_get_season_vector(now))
+        time_vector.extend(_get_day_vector(now))
+        time_vector.extend(_get_time_vector(now))
+
+        values = numpy.zeros(len(requests))
+        for meas_type, model in models.items():
+            rows = [i for i, (_, t) in enumerate(requests) if t == meas_type]
+            if not rows:
+                continue
+            matrix = numpy.array([
+                time_vector + list(self._get_bus_vector(requests[i][0]))
+                for i in rows])
+            values[rows] = model.predict(matrix)
+        return values.tolist()
+
+    def _get_bus_vector(self, bus_id):
+        if (self._bus_vectors is None
+                or self._network_key != _get_network_key(self._network)):
+            self.refresh()
+        return self._bus_vectors[bus_id]
+
 
 def _get_season_vector(now):
     year = 2000
@@ -60,9 +102,18 @@ def _get_time_vector(now):
     return (now.hour, now.minute)
 
 
-def _get_bus_vector(network, bus_id):
-    p = (network.load[network.load.bus == bus_id].p_mw.sum()
-         - network.sgen[network.sgen.bus == bus_id].p_mw.sum())
-    q = (network.load[network.load.bus == bus_id].q_mvar.sum()
-         - network.sgen[network.sgen.bus == bus_id].q_mvar.sum())
-    return (p, q, network.bus.iloc[bus_id].vn_kv)
+def _get_bus_vectors(network):
+    p = network.load.groupby('bus').p_mw.sum().sub(
+        network.sgen.groupby('bus').p_mw.sum(), fill_value=0)
+    q = network.load.groupby('bus').q_mvar.sum().sub(
+        network.sgen.groupby('bus').q_mvar.sum(), fill_value=0)
+    vectors = pandas.DataFrame({'p': p, 'q': q}).reindex(network.bus.index,
+                                                         fill_value=0)
+    vectors['vn_kv'] = network.bus.vn_kv
+    return dict(zip(vectors.index, vectors.itertuples(index=False,
+                                                      name=None)))
+
+
+def _get_network_key(network):
+    return tuple((id(table), len(table)) for table
+                 in (network.bus, network.load, network.sgen))
@@ -0,0 +1,223 @@
+"""Numerical observability analysis, used for pseudomeasurement placement"""
+import collections
+import heapq
+
+import numpy
+
+
+_branch_tables = {'line': ('from_bus', 'to_bus'),
+                  'trafo': ('hv_bus', 'lv_bus'),
+                  'impedance': ('from_bus', 'to_bus')}
+
+_tolerance = 1e-9
+
+
+def place_pseudomeasurements(network, candidates):
+    """Selects bus pseudomeasurements that make the network observable.
+
+    Observability is analysed separately for the decoupled active power -
+    voltage angle and reactive power - voltage magnitude subproblems, on the
+    structure of their measurement Jacobians. Voltage angles are referenced
+    to the external grid buses. Candidates are considered in the given order,
+    and one is selected only if it increases the rank of its subproblem's
+    Jacobian, until the rank equals the number of buses.
+
+    Branch flow measurements and voltage measurements are first reduced to
+    observable islands, after which only the island-level injection rows are
+    checked for rank, with sparse Gaussian elimination.
+
+    Args:
+        network: pandapower network with measurements
+        candidates: pairs of bus id and measurement type (``p`` or ``q``)
+
+    Returns:
+        List of selected candidates, in the given order"""
+    bus_index = {bus_id: i for i, bus_id in enumerate(network.bus.index)}
+    branches = _get_branches(network, bus_index)
+    weights = numpy.random.default_rng(0).uniform(1, 2, len(branches))
+    adjacency = _get_adjacency(len(bus_index), branches, weights)
+
+    selected = set()
+    for meas_type, reference_type in (('p', 'va'), ('q', 'v')):
+        references = set()
+        if meas_type == 'p':
+            references.update(bus_index[bus_id]
+                              for bus_id in network.ext_grid.bus)
+        injections = []
+        flows = []
+        for element_type, element, measurement_type in zip(
+                network.measurement.element_type,
+                network.measurement.element,
+                network.measurement.measurement_type):
+            if element_type == 'bus' and measurement_type == meas_type:
+                injections.append(bus_index[element])
+            elif element_type == 'bus' and measurement_type == reference_type:
+                references.add(bus_index[element])
+            elif ((element_type, element) in branches
+                  and measurement_type == meas_type):
+                flows.append(branches[element_type, element])
+
+        islands, island_count = _get_islands(len(bus_index), flows,
+                                             references)
+        basis = _Basis(_get_island_order(adjacency, islands, island_count))
+        for bus in injections:
+            basis.add(_injection_row(bus, adjacency, islands))
+
+        for candidate in candidates:
+            if basis.rank == island_count:
+                break
+            bus_id, candidate_type = candidate
+            if candidate_type != meas_type:
+                continue
+            row = _injection_row(bus_index[bus_id], adjacency, islands)
+            if basis.add(row):
+                selected.add(candidate)
+    return [candidate for candidate in candidates if candidate in selected]
+
+
+class _Basis:
+
+    """Rows in echelon form, kept as sparse column -> value dictionaries.
+    Pivot of every row is its column that comes first in the given column
+    order, so a new row is reduced by eliminating its pivot columns in that
+    order. Ordering columns so that leaves of the network come first keeps
+    the rows from filling in."""
+
+    def __init__(self, order):
+        self._order = order
+        self._rows = {}
+
+    @property
+    def rank(self):
+        return len(self._rows)
+
+    def add(self, row):
+        norm = max((abs(value) for value in row.values()), default=0)
+        row = dict(row)
+        queue = [(self._order[col], col) for col in row if col in self._rows]
+        heapq.heapify(queue)
+        while queue:
+            _, col = heapq.heappop(queue)
+            value = row.pop(col)
+            if abs(value) <= _tolerance * norm:
+                continue
+            pivot_row = self._rows[col]
+            factor = value / pivot_row[col]
+            for other, other_value in pivot_row.items():
+                if other == col:
+                    continue
+                if other not in row and other in self._rows:
+                    heapq.heappush(queue, (self._order[other], other))
+                row[other] = row.get(other, 0) - factor * other_value
+
+        row = {col: value for col, value in row.items()
+               if abs(value) > _tolerance * norm}
+        if not row:
+            return False
+        pivot = min(row, key=self._order.__getitem__)
+        self._rows[pivot] = row
+        return True
+
+
+def _get_branches(network, bus_index):
+    branches = {}
+    for table_name, (first, second) in _branch_tables.items():
+        table = getattr(network, table_name)
+        table = table[table.in_service]
+        for element, first_bus, second_bus in zip(table.index, table[first],
+                                                  table[second]):
+            branches[table_name, element] = (bus_index[first_bus],
+                                             bus_index[second_bus])
+    return branches
+
+
+def _get_adjacency(bus_count, branches, weights):
+    adjacency = [[] for _ in range(bus_count)]
+    for (first, second), weight in zip(branches.values(), weights.tolist()):
+        if first == second:
+            continue
+        adjacency[first].append((second, weight))
+        adjacency[second].append((first, weight))
+    return adjacency
+
+
+def _get_islands(bus_count, flows, references):
+    """Groups buses into observable islands, connected by branch flow
+    measurements. Islands containing a reference bus are merged into a
+    single grounded island, whose state is known.
+
+    Returns:
+        Tuple of island index of every bus, -1 for the grounded island, and
+        the number of other islands"""
+    parents = list(range(bus_count + 1))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    edges = list(flows) + [(bus, bus_count) for bus in references]
+    for first, second in edges:
+        first, second = find(first), find(second)
+        if first != second:
+            parents[max(first, second)] = min(first, second)
+
+    ground = find(bus_count)
+    roots = [find(i) for i in range(bus_count)]
+    island_ids = {}
+    islands = []
+    for root in roots:
+        if root == ground:
+            islands.append(-1)
+        else:
+            islands.append(island_ids.setdefault(root, len(island_ids)))
+    return islands, len(island_ids)
+
+
+def _get_island_order(adjacency, islands, island_count):
+    """Orders islands by decreasing breadth-first search depth from the
+    grounded island, so islands further from the references come first.
+    Islands not connected to the grounded island are searched from the first
+    one found.
+
+    Returns:
+        Dictionary of island index -> position"""
+    island_adjacency = [set() for _ in range(island_count + 1)]
+    for bus, neighbours in enumerate(adjacency):
+        for other, _ in neighbours:
+            if islands[bus] != islands[other]:
+                island_adjacency[islands[bus]].add(islands[other])
+
+    depths = [None] * (island_count + 1)
+    for root in [-1] + list(range(island_count)):
+        if depths[root] is not None:
+            continue
+        depths[root] = 0
+        queue = collections.deque([root])
+        while queue:
+            island = queue.popleft()
+            for other in island_adjacency[island]:
+                if depths[other] is None:
+                    depths[other] = depths[island] + 1
+                    queue.append(other)
+
+    ordered = sorted(range(island_count), key=lambda i: -depths[i])
+    return {island: position for position, island in enumerate(ordered)}
+
+
+def _injection_row(bus, adjacency, islands):
+    """Injection measurement row, in terms of island states. Branches inside
+    an island only contribute known state differences, and the grounded
+    island's state is known, so neither appears in the row."""
+    row = {}
+    island = islands[bus]
+    for other, weight in adjacency[bus]:
+        other_island = islands[other]
+        if other_island == island:
+            continue
+        if island >= 0:
+            row[island] = row.get(island, 0) + weight
+        if other_island >= 0:
+            row[other_island] = row.get(other_island, 0) - weight
+    return row
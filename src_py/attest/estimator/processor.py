@@ -1,18 +1,29 @@
 from collections import deque
 from pathlib import Path
 import click
+import copy
 import logging
+import numpy
 import pandapower.estimation
+import pandapower.estimation.algorithm.base
+import pandapower.estimation.ppc_conversion
+import pandapower.estimation.results
 import pandas
 import sys
 
 import attest.estimator.generator
+import attest.estimator.observability
 
 
 logging.basicConfig(stream=sys.stdout, level='INFO')
 
 mlog = logging.getLogger('attest.estimator.processor')
 
+_tolerance = 1e-6
+_maximum_iterations = 10
+_zero_injection = 'aux_bus'
+_warm_start_bounds = (0.5, 1.5)
+
 
 @click.command()
 @click.option('--matpower-path', type=Path,
@@ -43,7 +54,21 @@ refers to. For other types of elements can be set to null\n
                     'Point to a directory with files `p.pickle` and '
                     '`q.pickle`. Optional, if unset, internal models are '
                     'used.'))
-def main(matpower_path, readings_path, output_path, models_path):
+@click.option('--search', type=click.Choice(['exponential', 'linear']),
+              default='exponential',
+              help=('Strategy of searching for the smallest number of '
+                    'additional pseudomeasurements that makes the estimation '
+                    'succeed. Exponential doubles the number until the '
+                    'estimation succeeds, then bisects, linear adds one '
+                    'pseudomeasurement per estimation attempt.'))
+@click.option('--placement', type=click.Choice(['observability', 'sorted']),
+              default='observability',
+              help=('Order in which pseudomeasurements are added. '
+                    'Observability first adds the pseudomeasurements that '
+                    'observability analysis finds necessary, sorted adds them '
+                    'in order of bus ID and measurement type.'))
+def main(matpower_path, readings_path, output_path, models_path, search,
+         placement):
     """Based on given readings and network topology, attempts to approximate
     physical states of all topological nodes in the network. Writes to the
     output path a CSV table containing the following columns:
@@ -72,7 +97,7 @@ def main(matpower_path, readings_path, output_path, models_path):
             if (bus_id, meas_type) in missing:
                 missing.remove((bus_id, meas_type))
         pandapower.create_measurement(network, **measurement)
-    missing = deque(sorted(missing))
+    missing = sorted(missing)
 
     slacks = set()
     for bus_id in network.ext_grid.bus:
@@ -80,67 +105,154 @@ def main(matpower_path, readings_path, output_path, models_path):
             pandapower.create_measurement(network, 'v', 'bus', 1, 0.01, bus_id)
             slacks.add(bus_id)
 
+    required = []
+    if placement == 'observability':
+        required = attest.estimator.observability.place_pseudomeasurements(
+            network, missing)
+        mlog.info('observability analysis requires %s pseudomeasurements',
+                  len(required))
+        required_set = set(required)
+        missing = required + [i for i in missing if i not in required_set]
+    missing = deque(missing)
+
     generator = attest.estimator.generator.Generator(network, models_path)
-    while len(network.measurement) <= 2 * len(network.bus) - len(slacks):
-        network = _network_reset(network)
+    pseudomeasurements = dict(zip(missing,
+                                  generator.generate_batch(list(missing))))
+    for _ in required:
+        bus_id, meas_type = missing.popleft()
+        _add_pseudomeasurement(network, bus_id, meas_type,
+                               pseudomeasurements[bus_id, meas_type])
+    while (missing and
+           len(network.measurement) <= 2 * len(network.bus) - len(slacks)):
         bus_id, meas_type = missing.popleft()
-        value = generator.generate(bus_id, meas_type)
-        mlog.info('bus %s - generated %s pseudomeasurement of value %s',
-                  bus_id, meas_type, value)
-        pandapower.create_measurement(network, meas_type, 'bus', value, 0.1,
-                                      bus_id)
+        _add_pseudomeasurement(network, bus_id, meas_type,
+                               pseudomeasurements[bus_id, meas_type])
 
-    if _estimation_attempt(network, output_path):
+    estimation = _Estimation(network, output_path)
+    if estimation.attempt():
         return
 
+    if search == 'exponential':
+        return _exponential_search(network, estimation, missing,
+                                   pseudomeasurements)
+
     while missing:
-        network = _network_reset(network)
         bus_id, meas_type = missing.popleft()
-        value = generator.generate(bus_id, meas_type)
-        mlog.info('bus %s - generated %s pseudomeasurement of value %s',
-                  bus_id, meas_type, value)
-        pandapower.create_measurement(network, meas_type, 'bus', value, 0.1,
-                                      bus_id)
-        if _estimation_attempt(network, output_path):
+        _add_pseudomeasurement(network, bus_id, meas_type,
+                               pseudomeasurements[bus_id, meas_type])
+        if estimation.attempt():
             return
     return -1
 
 
-def _network_reset(network):
-    network_old = network
-    network = pandapower.create_empty_network()
-    network.bus = network_old.bus
-    network.line = network_old.line
-    network.switch = network_old.switch
-    network.load = network_old.load
-    network.motor = network_old.motor
-    network.asymmetric_load = network_old.asymmetric_load
-    network.sgen = network_old.sgen
-    network.ext_grid = network_old.ext_grid
-    network.trafo = network_old.trafo
-    network.trafo3w = network_old.trafo3w
-    network.gen = network_old.gen
-    network.shunt = network_old.shunt
-    network.impedance = network_old.impedance
-    network.ward = network_old.ward
-    network.xward = network_old.xward
-    network.dcline = network_old.dcline
-    network.measurement = network_old.measurement
-    network.storage = network_old.storage
-    return network
-
-
-def _estimation_attempt(network, output_path):
-    mlog.info('attempting estimation with %s measurements',
-              len(network.measurement))
-    try:
-        if pandapower.estimation.estimate(network):
-            mlog.info('estimation successful, writing output')
-            network.res_bus_est.to_csv(output_path, index=False)
-            return True
-    except Exception as e:
-        mlog.info('estimation failed %s', e)
-    return False
+class _Estimation:
+
+    """Repeated state estimation of a network whose measurements change between
+    attempts. The network is converted to the internal PYPOWER case only on the
+    first attempt. Since the estimation modifies the case, every attempt works
+    on a copy of that conversion, reusing only the admittance matrices built
+    from it, and converts a copy of the measurements. Every attempt is started
+    from the voltages its previous attempt ended with, or from a flat start on
+    the first attempt. Voltages of a failed attempt are used only if they are
+    finite and their magnitudes are between 0.5 and 1.5 p.u., otherwise the
+    attempt is started from the last voltages that were."""
+
+    def __init__(self, network, output_path):
+        self._network = network
+        self._output_path = output_path
+        self._case = None
+        self._admittances = {}
+        self._state = None
+
+    def attempt(self):
+        mlog.info('attempting estimation with %s measurements',
+                  len(self._network.measurement))
+        try:
+            if self._estimate():
+                mlog.info('estimation successful, writing output')
+                self._network.res_bus_est.to_csv(self._output_path,
+                                                 index=False)
+                return True
+        except Exception as e:
+            mlog.info('estimation failed %s', e)
+        return False
+
+    def _estimate(self):
+        conversion = pandapower.estimation.ppc_conversion
+        if self._case is None:
+            self._case = conversion._init_ppc(self._network, None, None, True)
+        ppc, ppci = copy.deepcopy(self._case)
+        ppci['internal'].update(self._admittances)
+
+        measurements = self._network.measurement
+        self._network.measurement = measurements.copy()
+        try:
+            ppci = conversion._add_measurements_to_ppci(self._network, ppci,
+                                                        _zero_injection)
+        finally:
+            self._network.measurement = measurements
+        eppci = conversion.ExtendedPPCI(ppci)
+        if self._state is not None:
+            eppci.update_E(self._state.copy())
+
+        solver = pandapower.estimation.algorithm.base.WLSAlgorithm(
+            _tolerance, _maximum_iterations)
+        eppci = solver.estimate(eppci)
+        if not self._admittances:
+            self._admittances = {key: eppci['internal'][key]
+                                 for key in ('Ybus', 'Yf', 'Yt')
+                                 if key in eppci['internal']}
+        if not solver.successful:
+            mlog.info('estimation failed to converge')
+            low, high = _warm_start_bounds
+            if (numpy.isfinite(eppci.E).all()
+                    and ((eppci.v >= low) & (eppci.v <= high)).all()):
+                self._state = eppci.E.copy()
+            return False
+        self._state = eppci.E.copy()
+        pandapower.estimation.results.eppci2pp(self._network, ppc, eppci)
+        return True
+
+
+def _exponential_search(network, estimation, missing, pseudomeasurements):
+    """Finds the shortest prefix of the missing measurements queue whose
+    pseudomeasurements make the estimation succeed, with a logarithmic
+    number of estimation attempts - prefix length is doubled until the
+    estimation succeeds, and then bisected between the longest failed and
+    the shortest successful length. Output of the shortest successful
+    attempt is written last. Assumes that adding pseudomeasurements doesn't
+    make a successful estimation fail."""
+    base_count = len(network.measurement)
+    for bus_id, meas_type in missing:
+        _add_pseudomeasurement(network, bus_id, meas_type,
+                               pseudomeasurements[bus_id, meas_type])
+    measurements = network.measurement
+
+    def attempt(count):
+        network.measurement = measurements.iloc[:base_count + count]
+        return estimation.attempt()
+
+    failed, succeeded = 0, 1
+    while succeeded < len(missing) and not attempt(succeeded):
+        failed, succeeded = succeeded, 2 * succeeded
+    if succeeded >= len(missing):
+        succeeded = len(missing)
+        if not missing or not attempt(succeeded):
+            return -1
+
+    while succeeded - failed > 1:
+        middle = (failed + succeeded) // 2
+        if attempt(middle):
+            succeeded = middle
+        else:
+            failed = middle
+
+
+def _add_pseudomeasurement(network, bus_id, meas_type, value):
+    mlog.info('bus %s - generated %s pseudomeasurement of value %s',
+              bus_id, meas_type, value)
+    pandapower.create_measurement(network, meas_type, 'bus', value, 0.1,
+                                  bus_id)
 
 
 if __name__ == '__main__':
@@ -1,51 +1,229 @@
+from flask import Response, request
+import atexit
 import datetime
-from flask import request
+import json
+import weakref
 
+import attest.server.cache
+import attest.server.encoding
+import attest.server.singleflight
+import attest.server.warmup
+import attest.topology.batch
+import attest.topology.compact
 import attest.topology.db
-import attest.topology.unprocessed
+import attest.topology.node_branch
+import attest.topology.node_breaker
 
 
 def create(app, prefix):
-    conn = attest.topology.db.Connection(dbname=app.config['DB_NAME'],
-                                         host=app.config['DB_HOST'],
-                                         port=app.config['DB_PORT'],
-                                         user=app.config['DB_USER'],
-                                         password=app.config['DB_PASSWORD'])
-    conn.connect()
-    app.teardown_appcontext(lambda e: conn.disconnect)
+    pool = attest.topology.db.ConnectionPool(
+        dbname=app.config['DB_NAME'],
+        host=app.config['DB_HOST'],
+        port=app.config['DB_PORT'],
+        user=app.config['DB_USER'],
+        password=app.config['DB_PASSWORD'],
+        min_size=app.config['DB_POOL_MIN_SIZE'],
+        max_size=app.config['DB_POOL_MAX_SIZE'])
+    atexit.register(pool.close)
+    cache = attest.server.cache.TopologyCache(
+        max_size=app.config['CACHE_SIZE'],
+        max_age=app.config['CACHE_MAX_AGE'])
+    flights = attest.server.singleflight.SingleFlight(
+        timeout=app.config['COALESCE_TIMEOUT'])
+
+    etags = weakref.WeakValueDictionary()
+
+    def get_topology(branch_id, commit_id, ordering):
+        stored_path = _stored_model_path(app.config.get('MODEL_PATH'),
+                                         branch_id, commit_id)
+        if stored_path is not None:
+            key = (branch_id, commit_id, 'stored', ordering)
+
+            def load():
+                return attest.topology.compact.CompactModel.load(stored_path)
+
+        else:
+            with pool.connection() as conn:
+                latest = conn.latest_commit(branch_id, commit_id)
+            key = (branch_id, commit_id, latest, ordering)
+
+            def load():
+                return attest.topology.compact.CompactModel.from_pool(
+                    pool, branch_id, commit_id,
+                    datetime.datetime.now(tz=datetime.timezone.utc),
+                    workers=app.config['DB_LOAD_WORKERS'])
+
+        def calculate():
+            cached = _calculate_topology(load(), branch_id, commit_id,
+                                         ordering)
+            cache.put(key, cached)
+            etags[cached[1].etag] = cached[1]
+            return cached
+
+        cached = cache.get(key)
+        if cached is None:
+            cached = flights.do(key, calculate)
+        return cached
+
+    if app.config.get('WARMUP_INTERVAL'):
+        def warm(branch_id, commit_id):
+            for ids in ((branch_id, commit_id), (None, None)):
+                _, topology = get_topology(*ids, 'lexicographic')
+                topology.npz()
+
+        listener = None
+        if app.config.get('WARMUP_CHANNEL'):
+            listener = attest.topology.db.Connection(
+                dbname=app.config['DB_NAME'],
+                host=app.config['DB_HOST'],
+                port=app.config['DB_PORT'],
+                user=app.config['DB_USER'],
+                password=app.config['DB_PASSWORD'])
+            listener.connect()
+            listener.listen(app.config['WARMUP_CHANNEL'])
+        warmer = attest.server.warmup.Warmer(
+            pool, warm, interval=app.config['WARMUP_INTERVAL'],
+            listener=listener)
+        warmer.start()
+        atexit.register(warmer.stop)
 
     @app.route(prefix, methods=['GET'])
     def calculate_topology():
+        response_format = attest.server.encoding.negotiate(
+            request.args.get('format'), request.accept_mimetypes)
+        if response_format is None:
+            return {'error': 'unsupported format'}, 406
+
         branch_id = _querystring_optional_int('branch_id')
         commit_id = _querystring_optional_int('commit_id')
-        timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
-
-        unprocessed = attest.topology.unprocessed.UnprocessedModel(
-            conn, branch_id, commit_id, timestamp)
-        node_breaker = attest.topology.node_breaker.NodeBreakerModel(
-            unprocessed)
-        node_branch = attest.topology.node_branch.NodeBranchModel(node_breaker)
-
-        admittance_sparse = []
-        for i, row in enumerate(node_branch.admittance_matrix):
-            for j, value in enumerate(row):
-                if value == 0:
-                    continue
-                admittance_sparse.append(_sparse_entry(i, j, value))
-
-        return {'branch_id': branch_id,
-                'commit_id': commit_id,
-                'datetime': timestamp.timestamp(),
-                'admittance_sparse_matrix': admittance_sparse,
-                'topological_nodes': [
-                    [node_mrid, list(elements)]
-                    for node_mrid, elements
-                    in node_branch.topological_nodes]
-                }, 'json'
-
-
-def _sparse_entry(i, j, value):
-    return {'row': i, 'col': j, 'value': [value.real, value.imag]}
+        since_commit_id = _querystring_optional_int('since_commit_id')
+        since_etag = request.args.get('since_etag')
+        ordering = request.args.get('ordering', 'lexicographic')
+        if ordering not in attest.topology.node_branch.orderings:
+            return {'error': f'unsupported ordering {ordering}'}, 400
+        is_delta = since_commit_id is not None or bool(since_etag)
+        if is_delta and response_format != 'json':
+            return {'error': 'delta responses are only available as JSON'}, 406
+
+        try:
+            _, topology = get_topology(branch_id, commit_id, ordering)
+            if since_etag:
+                since = etags.get(_content_hash(since_etag))
+                if since is None:
+                    return {'error': f'unknown etag {since_etag}'}, 412
+            elif since_commit_id is not None:
+                _, since = get_topology(branch_id, since_commit_id, ordering)
+        except TimeoutError as e:
+            return {'error': str(e)}, 504
+
+        gzip = bool(request.accept_encodings['gzip'])
+        etag = _etag(topology, response_format, gzip,
+                     since if is_delta else None)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        if is_delta:
+            chunks = [json.dumps(
+                attest.server.encoding.delta(topology, since))]
+            return _response(chunks, response_format, gzip, etag)
+        return _response(topology.encoded(response_format, gzip),
+                         response_format, gzip, etag, compressed=True)
+
+    @app.route(f'{prefix}/batch', methods=['GET'])
+    def calculate_topology_batch():
+        branch_id = _querystring_optional_int('branch_id')
+        first_commit_id = _querystring_optional_int('first_commit_id')
+        last_commit_id = _querystring_optional_int('last_commit_id')
+        if first_commit_id is None or last_commit_id is None:
+            return {'error': 'first_commit_id and last_commit_id are '
+                             'required'}, 400
+        commits = list(range(first_commit_id, last_commit_id + 1))
+        if not commits or len(commits) > app.config['BATCH_MAX_COMMITS']:
+            return {'error': 'commit range must contain between 1 and '
+                             f'{app.config["BATCH_MAX_COMMITS"]} '
+                             'commits'}, 400
+        ordering = request.args.get('ordering', 'lexicographic')
+        if ordering not in attest.topology.node_branch.orderings:
+            return {'error': f'unsupported ordering {ordering}'}, 400
+        deltas = request.args.get('deltas', '').lower() in ('1', 'true')
+
+        def chunks():
+            with pool.connection() as conn:
+                yield from _batch_chunks(conn, branch_id, commits, ordering,
+                                         deltas)
+
+        gzip = bool(request.accept_encodings['gzip'])
+        return _response(chunks(), 'json', gzip)
+
+    @app.route(f'{prefix}/cache', methods=['GET'])
+    def cache_stats():
+        return cache.stats()
+
+
+def _calculate_topology(model, branch_id, commit_id, ordering):
+    timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    node_breaker = attest.topology.node_breaker.NodeBreakerModel(model)
+    node_branch = attest.topology.node_branch.NodeBranchModel(
+        node_breaker, ordering=ordering)
+
+    return node_branch, attest.server.encoding.Topology(
+        branch_id, commit_id, timestamp, node_branch)
+
+
+def _batch_chunks(conn, branch_id, commits, ordering, deltas):
+    yield '['
+    previous = None
+    for commit_id, node_branch in attest.topology.batch.commit_range(
+            conn, branch_id, commits,
+            datetime.datetime.now(tz=datetime.timezone.utc), ordering):
+        topology = attest.server.encoding.Topology(
+            branch_id, commit_id,
+            datetime.datetime.now(tz=datetime.timezone.utc), node_branch)
+        if previous is not None:
+            yield ', '
+        if deltas and previous is not None:
+            yield json.dumps(attest.server.encoding.delta(topology, previous))
+        else:
+            yield from topology.json_chunks()
+        previous = topology
+    yield ']'
+
+
+def _response(chunks, response_format, gzip, etag=None, compressed=False):
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if gzip:
+        if not compressed:
+            chunks = attest.server.encoding.gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    response = Response(
+        chunks,
+        mimetype=attest.server.encoding.formats[response_format],
+        headers=headers)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def _etag(topology, response_format, gzip, since=None):
+    etag = f'{topology.etag}-{response_format}'
+    if since is not None:
+        etag = f'{etag}-delta-{since.etag}'
+    return f'{etag}-gzip' if gzip else etag
+
+
+def _content_hash(etag):
+    return etag.strip('"').split('-')[0]
+
+
+def _stored_model_path(root, branch_id, commit_id):
+    if not root:
+        return None
+    path = attest.topology.compact.stored_model_path(root, branch_id,
+                                                     commit_id)
+    return path if path.exists() else None
 
 
 def _querystring_optional_int(key):
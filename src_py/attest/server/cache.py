@@ -0,0 +1,94 @@
+"""In-process cache of computed topologies"""
+from typing import Any, Hashable, Optional
+import collections
+import threading
+import time
+
+
+class TopologyCache:
+
+    """Thread-safe LRU cache with size- and age-based eviction. Keeps track
+    of cache hits and misses.
+
+    Args:
+        max_size: maximum number of cached entries, least recently used entry
+            is evicted first
+        max_age: maximum entry age in seconds, if ``None`` entries don't
+            expire"""
+
+    def __init__(self,
+                 max_size: int = 32,
+                 max_age: Optional[float] = 300):
+        self._max_size = max_size
+        self._max_age = max_age
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def hits(self) -> int:
+        """Number of cache hits"""
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        """Number of cache misses"""
+        return self._misses
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get a cached value, counts a hit or a miss
+
+        Args:
+            key: cache key
+
+        Returns:
+            Cached value, or ``None`` if there is no entry for the key or it
+            has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        """Add a value to the cache, evicting the least recently used entries
+        if the cache is full
+
+        Args:
+            key: cache key
+            value: cached value"""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Cache statistics
+
+        Returns:
+            Dictionary with current size, maximum size, maximum age, hit and
+            miss counts"""
+        with self._lock:
+            return {'size': len(self._entries),
+                    'max_size': self._max_size,
+                    'max_age': self._max_age,
+                    'hits': self._hits,
+                    'misses': self._misses}
+
+    def _expired(self, entry):
+        if self._max_age is None:
+            return False
+        return time.monotonic() - entry[0] > self._max_age
@@ -6,3 +6,13 @@ DB_PORT = os.environ.get('DB_PORT') or 5432
 DB_USER = os.environ.get('DB_USER') or 'postgres'
 DB_PASSWORD = os.environ.get('DB_PASSWORD') or 'pass'
 DB_NAME = os.environ.get('DB_NAME') or 'cimrepokc'
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE') or 1)
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE') or 10)
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE') or 32)
+CACHE_MAX_AGE = float(os.environ.get('CACHE_MAX_AGE') or 300)
+MODEL_PATH = os.environ.get('MODEL_PATH')
+COALESCE_TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT') or 60)
+BATCH_MAX_COMMITS = int(os.environ.get('BATCH_MAX_COMMITS') or 1000)
+WARMUP_INTERVAL = float(os.environ.get('WARMUP_INTERVAL') or 0)
+WARMUP_CHANNEL = os.environ.get('WARMUP_CHANNEL')
+DB_LOAD_WORKERS = int(os.environ.get('DB_LOAD_WORKERS') or 4)
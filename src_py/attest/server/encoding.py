@@ -0,0 +1,284 @@
+"""Response formats of the topology API"""
+from typing import Iterable, Iterator, Optional
+import datetime
+import hashlib
+import io
+import json
+import threading
+import zlib
+
+import numpy
+
+import attest.topology.node_branch
+
+
+json_mimetype = 'application/json'
+npz_mimetype = 'application/x-npz'
+
+formats = {'json': json_mimetype,
+           'npz': npz_mimetype}
+"""Supported response formats, name -> mimetype"""
+
+_batch_size = 1000
+_delta_tolerance = 1e-12
+
+
+class Topology:
+
+    """Calculated topology, in a form that can be encoded into any of the
+    response formats. Encoded representations are built once and
+    reused. Topologies with equal admittance matrices and topological nodes
+    have equal :attr:`etag`, regardless of their ids and timestamps.
+
+    Args:
+        branch_id: CIM branch id
+        commit_id: CIM commit id
+        timestamp: time of calculation
+        node_branch: node-branch model"""
+
+    def __init__(self,
+                 branch_id: Optional[int],
+                 commit_id: Optional[int],
+                 timestamp: datetime.datetime,
+                 node_branch: attest.topology.node_branch.NodeBranchModel):
+        matrix = node_branch.admittance_matrix.tocoo()
+        nonzero = matrix.data != 0
+        self.branch_id = branch_id
+        self.commit_id = commit_id
+        self.timestamp = timestamp
+        self.rows = matrix.row[nonzero]
+        self.cols = matrix.col[nonzero]
+        self.values = matrix.data[nonzero]
+        self.topological_nodes = [[node_mrid, list(elements)]
+                                  for node_mrid, elements
+                                  in node_branch.topological_nodes]
+        self.ordering = node_branch.ordering
+        self.permutation = node_branch.permutation
+        self._etag = _content_hash(self.rows, self.cols, self.values,
+                                   self.topological_nodes)
+        self._npz = None
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def etag(self) -> str:
+        """Hexadecimal content hash"""
+        return self._etag
+
+    def json_chunks(self) -> Iterator[str]:
+        """Encodes the topology as JSON, yielding it in chunks of up to a
+        thousand matrix entries or topological nodes"""
+        yield json.dumps({'branch_id': self.branch_id,
+                          'commit_id': self.commit_id,
+                          'datetime': self.timestamp.timestamp()})[:-1]
+        if self.ordering != 'lexicographic':
+            yield ', "permutation": '
+            yield json.dumps(self.permutation.tolist())
+        yield ', "admittance_sparse_matrix": ['
+        yield from _json_items(self._sparse_entries())
+        yield '], "topological_nodes": ['
+        yield from _json_items(self.topological_nodes)
+        yield ']}'
+
+    def npz(self) -> bytes:
+        """Encodes the topology as an uncompressed NumPy ``.npz`` archive,
+        with arrays:
+
+            * ``row``, ``col`` - matrix entry indices\n
+            * ``value`` - complex matrix entry values\n
+            * ``nodes`` - topological node mRIDs, in matrix order\n
+            * ``elements`` - mRIDs of all elements of all topological nodes\n
+            * ``element_nodes`` - index of the topological node of every
+              element\n
+            * ``permutation`` - lexicographic index of every topological
+              node\n
+            * ``branch_id``, ``commit_id`` - ids, -1 if unset\n
+            * ``datetime`` - UNIX timestamp of the calculation\n
+        """
+        with self._lock:
+            if self._npz is None:
+                self._npz = self._encode_npz()
+        return self._npz
+
+    def encoded(self, format_name: str, gzip: bool = False
+                ) -> Iterator[bytes]:
+        """Encodes the topology in a response format. The first call streams
+        the encoding in chunks and records it, following calls yield the
+        recorded bytes.
+
+        Args:
+            format_name: response format name, see :data:`formats`
+            gzip: whether the encoding is gzip compressed"""
+        key = (format_name, gzip)
+        with self._lock:
+            encoded = self._encoded.get(key)
+        if encoded is not None:
+            yield encoded
+            return
+
+        if format_name == 'npz':
+            chunks = [self.npz()]
+        else:
+            chunks = self.json_chunks()
+        if gzip:
+            chunks = gzip_chunks(chunks)
+        recorded = []
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            recorded.append(chunk)
+            yield chunk
+        with self._lock:
+            self._encoded[key] = b''.join(recorded)
+
+    def _sparse_entries(self):
+        for i, j, value in zip(self.rows.tolist(), self.cols.tolist(),
+                               self.values.tolist()):
+            yield {'row': i, 'col': j, 'value': [value.real, value.imag]}
+
+    def _encode_npz(self):
+        elements = [element for _, node_elements in self.topological_nodes
+                    for element in node_elements]
+        element_nodes = numpy.repeat(
+            numpy.arange(len(self.topological_nodes)),
+            [len(node_elements) for _, node_elements
+             in self.topological_nodes])
+        f = io.BytesIO()
+        numpy.savez(
+            f,
+            row=self.rows,
+            col=self.cols,
+            value=self.values,
+            nodes=numpy.array([node.encode() for node, _
+                               in self.topological_nodes], dtype=bytes),
+            elements=numpy.array([element.encode() for element in elements],
+                                 dtype=bytes),
+            element_nodes=element_nodes,
+            permutation=self.permutation,
+            branch_id=numpy.int64(-1 if self.branch_id is None
+                                  else self.branch_id),
+            commit_id=numpy.int64(-1 if self.commit_id is None
+                                  else self.commit_id),
+            datetime=numpy.float64(self.timestamp.timestamp()))
+        return f.getvalue()
+
+
+def delta(topology: Topology, since: Topology) -> dict:
+    """Differences between two topologies, in a JSON-serializable form.
+    Since node indices aren't stable between topologies, matrix entries are
+    identified by topological node mRIDs. Matrix values that differ only by
+    rounding errors (relative difference up to 1e-12) are considered equal.
+
+    Args:
+        topology: current topology
+        since: earlier topology
+
+    Returns:
+        Dictionary with ids and timestamp of the current topology, both
+        etags, matrix entries that were added or changed
+        (``admittance_sparse_matrix``), matrix entries that were removed
+        (``removed_admittance_entries``), topological nodes that were added
+        or whose elements changed (``topological_nodes``) and mRIDs of
+        removed topological nodes (``removed_topological_nodes``)"""
+    nodes = [node for node, _ in topology.topological_nodes]
+    since_nodes = [node for node, _ in since.topological_nodes]
+    all_nodes, inverse = numpy.unique(nodes + since_nodes,
+                                      return_inverse=True)
+    node_count = len(all_nodes)
+    node_ids = inverse[:len(nodes)]
+    since_node_ids = inverse[len(nodes):]
+
+    keys = node_ids[topology.rows] * node_count + node_ids[topology.cols]
+    since_keys = (since_node_ids[since.rows] * node_count
+                  + since_node_ids[since.cols])
+    _, positions, since_positions = numpy.intersect1d(
+        keys, since_keys, assume_unique=True, return_indices=True)
+    changed = numpy.ones(len(keys), dtype=bool)
+    changed[positions] = ~numpy.isclose(topology.values[positions],
+                                        since.values[since_positions],
+                                        rtol=_delta_tolerance, atol=0)
+    removed = numpy.ones(len(since_keys), dtype=bool)
+    removed[since_positions] = False
+
+    since_groups = {node: set(elements)
+                    for node, elements in since.topological_nodes}
+    node_set = set(nodes)
+
+    return {
+        'branch_id': topology.branch_id,
+        'commit_id': topology.commit_id,
+        'datetime': topology.timestamp.timestamp(),
+        'etag': topology.etag,
+        'since_etag': since.etag,
+        'admittance_sparse_matrix': [
+            {'row': nodes[i], 'col': nodes[j],
+             'value': [value.real, value.imag]}
+            for i, j, value in zip(topology.rows[changed].tolist(),
+                                   topology.cols[changed].tolist(),
+                                   topology.values[changed].tolist())],
+        'removed_admittance_entries': [
+            [since_nodes[i], since_nodes[j]]
+            for i, j in zip(since.rows[removed].tolist(),
+                            since.cols[removed].tolist())],
+        'topological_nodes': [
+            [node, elements] for node, elements in topology.topological_nodes
+            if since_groups.get(node) != set(elements)],
+        'removed_topological_nodes': [node for node in since_nodes
+                                      if node not in node_set]}
+
+
+def negotiate(format_name: Optional[str],
+              accept_mimetypes) -> Optional[str]:
+    """Chooses the response format
+
+    Args:
+        format_name: explicitly requested format name, has precedence over
+            the accepted mimetypes
+        accept_mimetypes: request's accepted mimetypes
+
+    Returns:
+        Format name, or ``None`` if the explicitly requested format isn't
+        supported"""
+    if format_name:
+        return format_name if format_name in formats else None
+    best = accept_mimetypes.best_match([json_mimetype, npz_mimetype],
+                                       default=json_mimetype)
+    return 'npz' if best == npz_mimetype else 'json'
+
+
+def gzip_chunks(chunks: Iterable) -> Iterator[bytes]:
+    """Compresses a stream of chunks into a gzip stream
+
+    Args:
+        chunks: string or bytes chunks, strings are UTF-8 encoded"""
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _content_hash(rows, cols, values, topological_nodes):
+    digest = hashlib.sha1()
+    for array in (rows.astype('<i8'), cols.astype('<i8'),
+                  values.astype('<c16')):
+        digest.update(array.tobytes())
+    for node, elements in topological_nodes:
+        digest.update(f'{node}:{",".join(sorted(elements))};'.encode())
+    return digest.hexdigest()
+
+
+def _json_items(items):
+    batch = []
+    first = True
+    for item in items:
+        batch.append(item)
+        if len(batch) == _batch_size:
+            yield ('' if first else ', ') + json.dumps(batch)[1:-1]
+            first = False
+            batch = []
+    if batch:
+        yield ('' if first else ', ') + json.dumps(batch)[1:-1]
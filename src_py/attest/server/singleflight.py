@@ -0,0 +1,74 @@
+"""Coalescing of concurrent identical computations"""
+from typing import Any, Callable, Hashable, Optional
+import threading
+
+
+class SingleFlight:
+
+    """Makes sure only one computation per key is in flight at a time.
+    Callers requesting a key that is already being computed wait for the
+    running computation and share its result, or its exception.
+
+    Args:
+        timeout: default maximum number of seconds a caller waits for a
+            computation started by another caller, ``None`` waits
+            indefinitely"""
+
+    def __init__(self, timeout: Optional[float] = None):
+        self._timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self,
+           key: Hashable,
+           fn: Callable[[], Any],
+           timeout: Optional[float] = None) -> Any:
+        """Calls ``fn``, unless a call for the same key is already in
+        flight, in which case waits for it and returns its result
+
+        Args:
+            key: computation key
+            fn: computation
+            timeout: overrides the default timeout
+
+        Returns:
+            Result of the computation
+
+        Raises:
+            TimeoutError: if waiting for another caller's computation timed
+                out
+            Exception: exception raised by the computation is raised for all
+                the callers waiting on it"""
+        with self._lock:
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = self._calls[key] = _Call()
+
+        if not owner:
+            if timeout is None:
+                timeout = self._timeout
+            if not call.done.wait(timeout):
+                raise TimeoutError(f'computation of {key} timed out')
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
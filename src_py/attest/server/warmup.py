@@ -0,0 +1,99 @@
+"""Background precomputation of topologies of new commits"""
+from typing import Callable, Optional
+import logging
+import threading
+
+import attest.topology.db
+
+
+mlog = logging.getLogger('attest.server.warmup')
+
+
+class Warmer:
+
+    """Watches the CIM repository for new commits and precomputes their
+    topologies in a background thread. The repository is polled for its
+    latest commit periodically, and if a listener connection is given, also
+    whenever a notification arrives on its channel.
+
+    Args:
+        pool: connection pool used to poll for the latest commit
+        warm: called with branch id and commit id of every new latest
+            commit, expected to calculate and cache its topology
+        interval: number of seconds between polls
+        listener: connection subscribed to a notification channel with
+            :meth:`attest.topology.db.Connection.listen`, owned by the
+            warmer from then on"""
+
+    def __init__(self,
+                 pool: attest.topology.db.ConnectionPool,
+                 warm: Callable[[int, int], None],
+                 interval: float = 10,
+                 listener: Optional[attest.topology.db.Connection] = None):
+        self._pool = pool
+        self._warm = warm
+        self._interval = interval
+        self._listener = listener
+        self._latest = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def latest(self) -> Optional[tuple[int, int]]:
+        """Branch id and commit id of the latest warmed commit"""
+        return self._latest
+
+    def start(self):
+        """Starts the background thread"""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='attest-warmup', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread, waiting for the running
+        precomputation to finish"""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        if self._listener is not None:
+            self._listener.disconnect()
+            self._listener = None
+
+    def check(self) -> Optional[tuple[int, int]]:
+        """Polls the repository once and warms the latest commit if it
+        changed since the last check
+
+        Returns:
+            Branch id and commit id of the newly warmed commit, ``None`` if
+            the latest commit didn't change"""
+        with self._pool.connection() as conn:
+            latest = conn.latest_commit()
+        if latest is None or latest == self._latest:
+            return None
+        mlog.info('warming branch %s commit %s', *latest)
+        self._warm(*latest)
+        self._latest = latest
+        return latest
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                mlog.warning('warmup failed %s', e)
+            self._wait()
+
+    def _wait(self):
+        if self._listener is None:
+            self._stopped.wait(self._interval)
+            return
+        try:
+            self._listener.notifications(self._interval)
+        except Exception as e:
+            mlog.warning('listening failed %s', e)
+            self._stopped.wait(self._interval)
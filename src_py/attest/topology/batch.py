@@ -0,0 +1,84 @@
+"""Topologies of a range of commits, calculated from a single loaded model"""
+from datetime import datetime
+from typing import Iterator, Optional
+import click
+import sys
+
+from attest.topology import compact
+from attest.topology import db
+from attest.topology import node_branch
+from attest.topology import node_breaker
+
+
+def commit_range(connection: db.Connection,
+                 branch: Optional[int],
+                 commits: list[int],
+                 valid_time: Optional[datetime] = None,
+                 ordering: str = 'lexicographic'
+                 ) -> Iterator[tuple[int, node_branch.NodeBranchModel]]:
+    """Calculates topologies of multiple commits. CIM records are loaded once,
+    at the first commit, and only switch states are loaded for every commit
+    after it and applied to the model in commit order.
+
+    Args:
+        connection: database connection
+        branch: CIM branch id
+        commits: CIM commit ids, in order of calculation
+        valid_time: valid time of the loaded records
+        ordering: topological node ordering, see
+            :data:`attest.topology.node_branch.orderings`
+
+    Returns:
+        Pairs of commit id and the node-branch model at that commit. The
+        same model instance is updated for every commit, so it should be used
+        before advancing to the next one"""
+    if not commits:
+        return
+    model = compact.CompactModel.from_database(connection, branch,
+                                               commits[0], valid_time)
+    node_branch_model = node_branch.NodeBranchModel(
+        node_breaker.NodeBreakerModel(model), ordering=ordering)
+    yield commits[0], node_branch_model
+
+    switch_mrids = [model.mrid(i) for i in model.switch_ids.tolist()]
+    for commit in commits[1:]:
+        states = connection.snapshot(branch, commit, switch_mrids)
+        node_branch_model.apply_switch_changes({
+            mrid: states.get(mrid, 1) == 1 for mrid in switch_mrids})
+        yield commit, node_branch_model
+
+
+@click.command()
+@click.option('--dbname', help='name of the cim database', required=True)
+@click.option('--branch-id', type=int, default=None,
+              help='CIM branch id, latest if unset')
+@click.option('--first-commit-id', type=int, required=True,
+              help='first CIM commit id of the range')
+@click.option('--last-commit-id', type=int, required=True,
+              help='last CIM commit id of the range, inclusive')
+@click.option('--deltas', is_flag=True,
+              help='print only topological nodes that changed')
+def main(dbname, branch_id, first_commit_id, last_commit_id, deltas):
+    """Prints topologies of all commits in the given range"""
+    commits = list(range(first_commit_id, last_commit_id + 1))
+    previous = None
+    with db.connect(dbname) as c:
+        for commit, model in commit_range(c, branch_id, commits,
+                                          datetime.now()):
+            print(f'commit {commit}')
+            topological_nodes = {node_mrid: set(elements) for node_mrid,
+                                 elements in model.topological_nodes}
+            if not deltas or previous is None:
+                print(model.admittance_matrix.toarray())
+            else:
+                for node_mrid in sorted(previous.keys()
+                                        - topological_nodes.keys()):
+                    print(f'- {node_mrid}')
+                for node_mrid, elements in sorted(topological_nodes.items()):
+                    if previous.get(node_mrid) != elements:
+                        print(f'+ {node_mrid} {sorted(elements)}')
+            previous = topological_nodes
+
+
+if __name__ == '__main__':
+    sys.exit(main())
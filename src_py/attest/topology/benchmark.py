@@ -0,0 +1,156 @@
+"""Scaling benchmark for the topology processing steps on synthetic networks"""
+import click
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+import attest.topology.compact
+import attest.topology.node_branch
+import attest.topology.node_breaker
+
+
+class SyntheticModel:
+
+    """Synthetic network with the same interface as
+    :class:`attest.topology.unprocessed.UnprocessedModel`. Connectivity nodes
+    are laid out as a ring, each one has a busbar section attached to it and
+    is connected to the next node with a breaker. Additional disconnectors
+    connect randomly chosen node pairs, making long chains and cycles of
+    closed switches. AC line segments with random parameters connect every
+    node with a node further down the ring.
+
+    Args:
+        node_count: number of connectivity nodes
+        closed_ratio: probability that a switch is closed
+        seed: random generator seed"""
+
+    def __init__(self,
+                 node_count: int,
+                 closed_ratio: float = 0.7,
+                 seed: int = 0):
+        rng = random.Random(seed)
+
+        def new_mrid():
+            return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+        node_set = []
+        asset_map = {}
+        switch_map = {}
+        terminal_map = {}
+        connectivity_map = {}
+
+        def add_equipment(cimclass, node_mrids, **attributes):
+            mrid = new_mrid()
+            asset_map[mrid] = dict(attributes, mrid=mrid, cimclass=cimclass)
+            terminal_map[mrid] = []
+            for node_mrid in node_mrids:
+                terminal_mrid = new_mrid()
+                asset_map[terminal_mrid] = {
+                    'mrid': terminal_mrid,
+                    'cimclass': 'cim:Terminal',
+                    'cim:Terminal.ConductingEquipment': mrid,
+                    'cim:Terminal.ConnectivityNode': node_mrid}
+                terminal_map[mrid].append(terminal_mrid)
+                connectivity_map[node_mrid].append(terminal_mrid)
+            return mrid
+
+        for _ in range(node_count):
+            mrid = new_mrid()
+            record = {'mrid': mrid, 'cimclass': 'cim:ConnectivityNode'}
+            node_set.append(record)
+            asset_map[mrid] = record
+            connectivity_map[mrid] = []
+
+        for i, node in enumerate(node_set):
+            add_equipment('cim:BusbarSection', [node['mrid']])
+            next_node = node_set[(i + 1) % node_count]
+            switch_mrid = add_equipment('cim:Breaker',
+                                        [node['mrid'], next_node['mrid']])
+            switch_map[switch_mrid] = rng.random() < closed_ratio
+
+            line_end = node_set[(i + rng.randint(2, 10)) % node_count]
+            add_equipment('cim:ACLineSegment',
+                          [node['mrid'], line_end['mrid']],
+                          **{'cim:ACLineSegment.r': rng.uniform(0.01, 1),
+                             'cim:ACLineSegment.x': rng.uniform(0.01, 1),
+                             'cim:ACLineSegment.gch': 0,
+                             'cim:ACLineSegment.bch': rng.uniform(0, 1e-4),
+                             'cim:ACLineSegment.r0': None,
+                             'cim:ACLineSegment.x0': None,
+                             'cim:ACLineSegment.g0ch': None,
+                             'cim:ACLineSegment.b0ch': None})
+
+        for _ in range(node_count // 10):
+            first, second = rng.sample(node_set, 2)
+            switch_mrid = add_equipment('cim:Disconnector',
+                                        [first['mrid'], second['mrid']])
+            switch_map[switch_mrid] = rng.random() < closed_ratio
+
+        self.node_set = node_set
+        self.asset_map = asset_map
+        self.switch_map = switch_map
+        self.terminal_map = terminal_map
+        self.connectivity_map = connectivity_map
+
+
+@click.command()
+@click.option('--sizes', default='10000,100000,1000000',
+              help='comma-separated connectivity node counts')
+@click.option('--repeat', default=3, help='number of timed runs per size')
+@click.option('--memory', is_flag=True,
+              help='also compare memory used by the unprocessed and compact '
+                   'models')
+def main(sizes, repeat, memory):
+    """Measures compact model conversion, node merging and admittance matrix
+    calculation durations on synthetic networks of given sizes"""
+    for size in (int(size) for size in sizes.split(',')):
+        if memory:
+            tracemalloc.start()
+        model = SyntheticModel(size)
+        if memory:
+            unprocessed_size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        compact = attest.topology.compact.CompactModel.from_unprocessed(model)
+        node_breaker = attest.topology.node_breaker.NodeBreakerModel(compact)
+        print(f'{size} connectivity nodes, '
+              f'{len(node_breaker.topological_nodes)} topological nodes')
+        if memory:
+            compact_size = _compact_size(compact)
+            print(f'    memory: '
+                  f'unprocessed {unprocessed_size / 2**20:.1f}MiB, '
+                  f'compact {compact_size / 2**20:.1f}MiB')
+        stages = [('compact conversion',
+                   attest.topology.compact.CompactModel.from_unprocessed,
+                   model),
+                  ('node merging',
+                   attest.topology.node_breaker.NodeBreakerModel, compact),
+                  ('admittance matrix',
+                   attest.topology.node_branch._calculate_admittance_matrix,
+                   node_breaker)]
+        for name, fn, arg in stages:
+            best = _best_duration(fn, arg, repeat)
+            print(f'    {name}: best of {repeat}: {best:.3f}s, '
+                  f'{best / size * 1e6:.2f}us per node')
+
+
+def _compact_size(compact):
+    arrays = [compact.mrids, compact.classes, compact.terminal_equipment,
+              compact.terminal_node, *compact.equipment_terminals,
+              *compact.node_terminals, compact.switch_states,
+              compact.line_ids, compact.line_parameters]
+    return sum(array.nbytes for array in arrays)
+
+
+def _best_duration(fn, arg, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,613 @@
+"""Compact, array-backed representation of the unprocessed model"""
+from datetime import datetime
+from pathlib import Path
+import click
+import concurrent.futures
+import json
+import queue
+import shutil
+import sys
+import tempfile
+import typing
+
+import numpy
+
+from attest.topology import db
+from attest.topology import unprocessed
+
+
+cim_classes = tuple(unprocessed.projection)
+"""CIM classes of the loaded records, class codes are indices in this tuple"""
+
+switch_classes = ('cim:Breaker', 'cim:Disconnector')
+
+_id_dtype = numpy.int32
+
+_batch_size = 2000
+
+storage_version = 1
+"""Version of the on-disk format written by :meth:`CompactModel.save`"""
+
+_stored_arrays = ('mrids', 'classes', 'terminal_equipment', 'terminal_node',
+                  'equipment_terminals_indptr', 'equipment_terminals_indices',
+                  'node_terminals_indptr', 'node_terminals_indices',
+                  'switch_states', 'line_ids', 'line_parameters')
+
+line_attributes = ('cim:ACLineSegment.r', 'cim:ACLineSegment.x',
+                   'cim:ACLineSegment.gch', 'cim:ACLineSegment.bch')
+line_fallback_attributes = ('cim:ACLineSegment.r0', 'cim:ACLineSegment.x0',
+                            'cim:ACLineSegment.g0ch',
+                            'cim:ACLineSegment.b0ch')
+
+
+class LineSegment:
+
+    """Parameters of a single AC line segment, with zero-sequence fallbacks
+    already applied
+
+    Args:
+        mrid: line segment mRID
+        r: series resistance
+        x: series reactance
+        gch: shunt conductance
+        bch: shunt susceptance"""
+
+    __slots__ = ('mrid', 'r', 'x', 'gch', 'bch')
+
+    def __init__(self, mrid: str, r: float, x: float, gch: float,
+                 bch: float):
+        self.mrid = mrid
+        self.r = r
+        self.x = x
+        self.gch = gch
+        self.bch = bch
+
+
+class CompactModel:
+
+    """Unprocessed model where every mRID is interned to a dense integer id,
+    and all structures are stored in NumPy arrays indexed by those ids.
+    Equipment -> terminals and connectivity node -> terminals adjacencies are
+    stored in CSR form - terminals of element ``i`` are ``indices[indptr[i]:
+    indptr[i + 1]]``.
+
+    Models are usually created with :meth:`from_database` or
+    :meth:`from_unprocessed`.
+
+    Args:
+        mrids: id -> mRID, as ASCII bytes
+        classes: id -> index of the class in :data:`cim_classes`, ``-1`` for
+            mRIDs that are only referenced
+        terminal_equipment: id -> id of the terminal's conducting equipment,
+            ``-1`` for non-terminals
+        terminal_node: id -> id of the terminal's connectivity node, ``-1``
+            for non-terminals
+        equipment_terminals: CSR pair ``(indptr, indices)`` of equipment ->
+            terminal ids
+        node_terminals: CSR pair ``(indptr, indices)`` of connectivity node
+            -> terminal ids
+        switch_states: id -> ``True`` if element is a closed switch
+        line_ids: ids of AC line segments
+        line_parameters: one row per line segment, columns are
+            :data:`line_attributes` followed by
+            :data:`line_fallback_attributes`, NaN if missing"""
+
+    def __init__(self,
+                 mrids: numpy.ndarray,
+                 classes: numpy.ndarray,
+                 terminal_equipment: numpy.ndarray,
+                 terminal_node: numpy.ndarray,
+                 equipment_terminals: tuple[numpy.ndarray, numpy.ndarray],
+                 node_terminals: tuple[numpy.ndarray, numpy.ndarray],
+                 switch_states: numpy.ndarray,
+                 line_ids: numpy.ndarray,
+                 line_parameters: numpy.ndarray):
+        self._mrids = mrids
+        self._classes = classes
+        self._terminal_equipment = terminal_equipment
+        self._terminal_node = terminal_node
+        self._equipment_terminals = equipment_terminals
+        self._node_terminals = node_terminals
+        self._switch_states = switch_states
+        self._line_ids = line_ids
+        self._line_parameters = line_parameters
+        self._ids = None
+
+    @classmethod
+    def from_database(cls,
+                      connection: db.Connection,
+                      branch: typing.Optional[int],
+                      commit: typing.Optional[int],
+                      valid_time: typing.Optional[datetime]
+                      ) -> 'CompactModel':
+        """Loads the model from the database, without building intermediate
+        per-record dictionaries
+
+        Args:
+            connection: reference to the topology database connection object
+            branch: CIM branch id - if None, latest is used
+            commit: CIM commit id - if None, latest is used
+            valid_time: system snapshot time - if None, latest is used"""
+        classes = connection.get_classes()
+        classes = {row['cimclass']: row['cimclassid'] for row in classes}
+        class_ids = [classes[name] for name in cim_classes]
+        records = connection.recordat_stream(
+            branch, commit, valid_time, cim_class_ids=class_ids,
+            projection=unprocessed.projection)
+
+        builder = _Builder()
+        for record in records:
+            builder.add(str(record['mrid']), record['cimclass'],
+                        record['fullobject'])
+        snapshot = connection.snapshot(branch, commit, builder.switch_mrids())
+        return builder.build({mrid: state == 1
+                              for mrid, state in snapshot.items()})
+
+    @classmethod
+    def from_pool(cls,
+                  pool: db.ConnectionPool,
+                  branch: typing.Optional[int],
+                  commit: typing.Optional[int],
+                  valid_time: typing.Optional[datetime],
+                  workers: typing.Optional[int] = None
+                  ) -> 'CompactModel':
+        """Loads the model from the database like :meth:`from_database`, but
+        fetches every CIM class concurrently, each over its own pooled
+        connection. Records are added to the model as they arrive, while the
+        other classes are still being fetched, and switch states are fetched
+        as soon as the switch records are.
+
+        Args:
+            pool: connection pool
+            branch: CIM branch id - if None, latest is used
+            commit: CIM commit id - if None, latest is used
+            valid_time: system snapshot time - if None, latest is used
+            workers: maximum number of classes fetched at the same time, if
+                None all classes are fetched at the same time"""
+        with pool.connection() as connection:
+            classes = connection.get_classes()
+        classes = {row['cimclass']: row['cimclassid'] for row in classes}
+        messages = queue.Queue()
+
+        def fetch(name):
+            try:
+                with pool.connection() as connection:
+                    switch_mrids = []
+                    batch = []
+                    for record in connection.recordat_stream(
+                            branch, commit, valid_time,
+                            cim_class_ids=[classes[name]],
+                            projection=unprocessed.projection):
+                        batch.append(record)
+                        if name in switch_classes:
+                            switch_mrids.append(str(record['mrid']))
+                        if len(batch) == _batch_size:
+                            messages.put(('records', batch))
+                            batch = []
+                    messages.put(('records', batch))
+                    if switch_mrids:
+                        messages.put(('states', connection.snapshot(
+                            branch, commit, switch_mrids)))
+            finally:
+                messages.put(('done', None))
+
+        builder = _Builder()
+        switch_map = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                workers or len(cim_classes)) as executor:
+            futures = [executor.submit(fetch, name) for name in cim_classes]
+            pending = len(futures)
+            while pending:
+                kind, payload = messages.get()
+                if kind == 'records':
+                    for record in payload:
+                        builder.add(str(record['mrid']), record['cimclass'],
+                                    record['fullobject'])
+                elif kind == 'states':
+                    switch_map.update((mrid, state == 1)
+                                      for mrid, state in payload.items())
+                else:
+                    pending -= 1
+            for future in futures:
+                future.result()
+        return builder.build(switch_map)
+
+    @classmethod
+    def from_unprocessed(cls,
+                         model: unprocessed.UnprocessedModel
+                         ) -> 'CompactModel':
+        """Converts an unprocessed model
+
+        Args:
+            model: unprocessed model"""
+        builder = _Builder()
+        for mrid, record in model.asset_map.items():
+            builder.add(mrid, record['cimclass'], record)
+        return builder.build(model.switch_map)
+
+    @classmethod
+    def load(cls, path: Path) -> 'CompactModel':
+        """Loads a model stored with :meth:`save`. Arrays are memory-mapped
+        and read lazily, only switch states are copied into memory so they
+        can be changed.
+
+        Args:
+            path: stored model directory
+
+        Raises:
+            ValueError: if the model was stored in an unsupported version"""
+        path = Path(path)
+        metadata = load_metadata(path)
+        if metadata.get('version') != storage_version:
+            raise ValueError(f"unsupported stored model version "
+                             f"{metadata.get('version')}")
+        arrays = {name: numpy.load(path / f'{name}.npy', mmap_mode='r')
+                  for name in _stored_arrays}
+        return cls(
+            mrids=arrays['mrids'],
+            classes=arrays['classes'],
+            terminal_equipment=arrays['terminal_equipment'],
+            terminal_node=arrays['terminal_node'],
+            equipment_terminals=(arrays['equipment_terminals_indptr'],
+                                 arrays['equipment_terminals_indices']),
+            node_terminals=(arrays['node_terminals_indptr'],
+                            arrays['node_terminals_indices']),
+            switch_states=numpy.array(arrays['switch_states']),
+            line_ids=arrays['line_ids'],
+            line_parameters=arrays['line_parameters'])
+
+    def save(self,
+             path: Path,
+             branch: typing.Optional[int] = None,
+             commit: typing.Optional[int] = None):
+        """Stores the model into a directory, one uncompressed ``.npy`` file
+        per array, along with a ``metadata.json`` file containing the format
+        version and the given branch and commit ids. The directory is written
+        next to the destination and moved into place once complete, replacing
+        any previous content.
+
+        Args:
+            path: destination directory
+            branch: CIM branch id the model was loaded for
+            commit: CIM commit id the model was loaded for"""
+        arrays = {
+            'mrids': self._mrids,
+            'classes': self._classes,
+            'terminal_equipment': self._terminal_equipment,
+            'terminal_node': self._terminal_node,
+            'equipment_terminals_indptr': self._equipment_terminals[0],
+            'equipment_terminals_indices': self._equipment_terminals[1],
+            'node_terminals_indptr': self._node_terminals[0],
+            'node_terminals_indices': self._node_terminals[1],
+            'switch_states': self._switch_states,
+            'line_ids': self._line_ids,
+            'line_parameters': self._line_parameters}
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(tempfile.mkdtemp(dir=path.parent,
+                                         prefix=f'.{path.name}.'))
+        tmp_path.chmod(0o755)
+        try:
+            for name, array in arrays.items():
+                numpy.save(tmp_path / f'{name}.npy', array)
+            with open(tmp_path / 'metadata.json', 'w') as f:
+                json.dump({'version': storage_version,
+                           'branch_id': branch,
+                           'commit_id': commit}, f)
+            if path.exists():
+                shutil.rmtree(path)
+            tmp_path.rename(path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    @property
+    def size(self) -> int:
+        """Number of interned mRIDs"""
+        return len(self._mrids)
+
+    @property
+    def mrids(self) -> numpy.ndarray:
+        """id -> mRID, as ASCII bytes"""
+        return self._mrids
+
+    @property
+    def classes(self) -> numpy.ndarray:
+        """id -> class code"""
+        return self._classes
+
+    @property
+    def terminal_equipment(self) -> numpy.ndarray:
+        """Terminal id -> conducting equipment id"""
+        return self._terminal_equipment
+
+    @property
+    def terminal_node(self) -> numpy.ndarray:
+        """Terminal id -> connectivity node id"""
+        return self._terminal_node
+
+    @property
+    def equipment_terminals(self) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Equipment -> terminals CSR pair"""
+        return self._equipment_terminals
+
+    @property
+    def node_terminals(self) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Connectivity node -> terminals CSR pair"""
+        return self._node_terminals
+
+    @property
+    def switch_states(self) -> numpy.ndarray:
+        """id -> ``True`` if element is a closed switch"""
+        return self._switch_states
+
+    @property
+    def line_ids(self) -> numpy.ndarray:
+        """AC line segment ids"""
+        return self._line_ids
+
+    @property
+    def line_parameters(self) -> numpy.ndarray:
+        """AC line segment parameter table"""
+        return self._line_parameters
+
+    @property
+    def node_ids(self) -> numpy.ndarray:
+        """Connectivity node ids"""
+        code = cim_classes.index('cim:ConnectivityNode')
+        return numpy.flatnonzero(self._classes == code)
+
+    @property
+    def switch_ids(self) -> numpy.ndarray:
+        """Breaker and disconnector ids"""
+        codes = [cim_classes.index(name) for name in switch_classes]
+        return numpy.flatnonzero(numpy.isin(self._classes, codes))
+
+    @property
+    def switch_map(self) -> dict[str, bool]:
+        """Switch map, built on access"""
+        return {self.mrid(i): bool(self._switch_states[i])
+                for i in self.switch_ids.tolist()}
+
+    @property
+    def terminal_map(self) -> dict[str, list[str]]:
+        """Terminal map, built on access"""
+        indptr, indices = self._equipment_terminals
+        equipment = numpy.flatnonzero(numpy.diff(indptr))
+        return {self.mrid(i): [self.mrid(t) for t
+                               in indices[indptr[i]:indptr[i + 1]].tolist()]
+                for i in equipment.tolist()}
+
+    def mrid(self, i: int) -> str:
+        """mRID of the given id"""
+        return self._mrids[i].decode()
+
+    def id(self, mrid: str) -> typing.Optional[int]:
+        """Id of the given mRID, or ``None`` if it isn't interned. The first
+        call builds a lookup table."""
+        if self._ids is None:
+            self._ids = {mrid.decode(): i
+                         for i, mrid in enumerate(self._mrids.tolist())}
+        return self._ids.get(mrid)
+
+    def line_segment(self, i: int) -> LineSegment:
+        """Parameters of the line segment at position ``i`` of
+        :attr:`line_ids`"""
+        return LineSegment(self.mrid(self._line_ids[i]),
+                           *line_values(self._line_parameters[i:i + 1])[0])
+
+    def set_switch_states(self, states: dict[str, bool]) -> numpy.ndarray:
+        """Updates switch states
+
+        Args:
+            states: mapping switch mRID -> new state, ``True`` if closed
+
+        Returns:
+            Ids of switches whose state changed"""
+        known = [(self.id(mrid), bool(state))
+                 for mrid, state in states.items()]
+        known = [(i, state) for i, state in known if i is not None]
+        ids = numpy.array([i for i, _ in known], dtype=_id_dtype)
+        values = numpy.array([state for _, state in known], dtype=bool)
+        switches = numpy.isin(self._classes[ids],
+                              [cim_classes.index(name)
+                               for name in switch_classes])
+        ids, values = ids[switches], values[switches]
+        changed = self._switch_states[ids] != values
+        self._switch_states[ids] = values
+        return ids[changed]
+
+
+def load(dbname: typing.Optional[str],
+         model_path: typing.Optional[Path],
+         branch: typing.Optional[int] = None,
+         commit: typing.Optional[int] = None) -> CompactModel:
+    """Loads a model either from a stored model directory, if given, or from
+    the database. Used by the command line interfaces.
+
+    Args:
+        dbname: database name
+        model_path: stored model directory
+        branch: CIM branch id, used only when loading from the database
+        commit: CIM commit id, used only when loading from the database"""
+    if model_path is not None:
+        return CompactModel.load(model_path)
+    if dbname is None:
+        raise click.UsageError('either --dbname or --model-path is required')
+    with db.connect(dbname) as c:
+        return CompactModel.from_database(c, branch, commit, datetime.now())
+
+
+def stored_model_path(root: Path,
+                      branch: typing.Optional[int],
+                      commit: typing.Optional[int]) -> Path:
+    """Path of the stored model of the given branch and commit inside a
+    directory of stored models
+
+    Args:
+        root: stored models directory
+        branch: CIM branch id, ``None`` for latest
+        commit: CIM commit id, ``None`` for latest"""
+    branch = 'latest' if branch is None else branch
+    commit = 'latest' if commit is None else commit
+    return Path(root) / f'{branch}_{commit}'
+
+
+def load_metadata(path: Path) -> dict:
+    """Reads metadata of a model stored with :meth:`CompactModel.save`
+
+    Args:
+        path: stored model directory
+
+    Returns:
+        Dictionary with keys ``version``, ``branch_id`` and ``commit_id``"""
+    with open(Path(path) / 'metadata.json') as f:
+        return json.load(f)
+
+
+def line_values(parameters: numpy.ndarray) -> numpy.ndarray:
+    """Resolves zero-sequence fallbacks of a line parameter table
+
+    Args:
+        parameters: table with columns :data:`line_attributes` followed by
+            :data:`line_fallback_attributes`
+
+    Returns:
+        Table with columns r, x, gch, bch - a value is taken from its
+        fallback column when it is missing or zero, and is zero if both are
+        missing"""
+    primary = parameters[:, :len(line_attributes)]
+    fallback = parameters[:, len(line_attributes):]
+    missing = numpy.isnan(primary) | (primary == 0)
+    return numpy.nan_to_num(numpy.where(missing, fallback, primary))
+
+
+def csr_rows(csr: tuple[numpy.ndarray, numpy.ndarray],
+             rows: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """Gathers the values of multiple CSR rows
+
+    Args:
+        csr: CSR pair ``(indptr, indices)``
+        rows: row ids
+
+    Returns:
+        Pair of arrays - the row id of every gathered value, and the values"""
+    indptr, indices = csr
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    owners = numpy.repeat(rows, counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(
+        numpy.cumsum(counts) - counts, counts)
+    return owners, indices[numpy.repeat(starts, counts) + offsets]
+
+
+class _Builder:
+
+    def __init__(self):
+        self._ids = {}
+        self._classes = []
+        self._terminals = []
+        self._terminal_equipment = []
+        self._terminal_node = []
+        self._line_ids = []
+        self._line_parameters = []
+
+    def add(self, mrid, cimclass, attributes):
+        i = self._intern(mrid)
+        code = (cim_classes.index(cimclass) if cimclass in cim_classes
+                else -1)
+        self._classes[i] = code
+        if cimclass == 'cim:Terminal':
+            self._terminals.append(i)
+            self._terminal_equipment.append(self._intern(
+                attributes.get('cim:Terminal.ConductingEquipment')))
+            self._terminal_node.append(self._intern(
+                attributes.get('cim:Terminal.ConnectivityNode')))
+        elif cimclass == 'cim:ACLineSegment':
+            self._line_ids.append(i)
+            self._line_parameters.append(
+                [attributes.get(attribute) for attribute
+                 in line_attributes + line_fallback_attributes])
+
+    def switch_mrids(self):
+        codes = [cim_classes.index(name) for name in switch_classes]
+        return [mrid for mrid, i in self._ids.items()
+                if self._classes[i] in codes]
+
+    def build(self, switch_map):
+        size = len(self._ids)
+        mrids = numpy.array([mrid.encode() for mrid in self._ids],
+                            dtype=bytes)
+        classes = numpy.array(self._classes, dtype=numpy.int8)
+        terminals = numpy.array(self._terminals, dtype=_id_dtype)
+        terminal_equipment = numpy.full(size, -1, dtype=_id_dtype)
+        terminal_equipment[terminals] = self._terminal_equipment
+        terminal_node = numpy.full(size, -1, dtype=_id_dtype)
+        terminal_node[terminals] = self._terminal_node
+
+        switch_states = numpy.zeros(size, dtype=bool)
+        codes = [cim_classes.index(name) for name in switch_classes]
+        switch_states[numpy.isin(classes, codes)] = True
+        for mrid, state in switch_map.items():
+            if mrid in self._ids:
+                switch_states[self._ids[mrid]] = state
+
+        # lines ordered by mRID, so admittance values are summed in the same
+        # order regardless of the order records were added in
+        line_ids = numpy.array(self._line_ids, dtype=_id_dtype)
+        line_parameters = numpy.array(
+            self._line_parameters, dtype=float).reshape(
+                -1, len(line_attributes + line_fallback_attributes))
+        line_order = numpy.argsort(mrids[line_ids], kind='stable')
+
+        return CompactModel(
+            mrids=mrids,
+            classes=classes,
+            terminal_equipment=terminal_equipment,
+            terminal_node=terminal_node,
+            equipment_terminals=_csr(size, terminals,
+                                     terminal_equipment[terminals]),
+            node_terminals=_csr(size, terminals, terminal_node[terminals]),
+            switch_states=switch_states,
+            line_ids=line_ids[line_order],
+            line_parameters=line_parameters[line_order])
+
+    def _intern(self, mrid):
+        if mrid is None:
+            return -1
+        mrid = str(mrid)
+        i = self._ids.get(mrid)
+        if i is None:
+            i = self._ids[mrid] = len(self._ids)
+            self._classes.append(-1)
+        return i
+
+
+def _csr(size, values, rows):
+    valid = rows >= 0
+    values, rows = values[valid], rows[valid]
+    order = numpy.argsort(rows, kind='stable')
+    indptr = numpy.zeros(size + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, values[order]
+
+
+@click.command()
+@click.option('--dbname', help='name of the cim database', required=True)
+@click.option('--branch-id', type=int, default=None,
+              help='CIM branch id, latest if unset')
+@click.option('--commit-id', type=int, default=None,
+              help='CIM commit id, latest if unset')
+@click.option('--path', type=Path, required=True,
+              help='output directory of the stored model')
+def main(dbname, branch_id, commit_id, path):
+    """Loads the model of the given branch and commit from the database and
+    stores it to the given path, so it can be loaded without the database"""
+    with db.connect(dbname) as c:
+        model = CompactModel.from_database(c, branch_id, commit_id,
+                                           datetime.now())
+    model.save(path, branch_id, commit_id)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,17 @@
 """Module in charge of database interactions"""
-from typing import Optional
+from typing import Iterator, Optional
 import click
 import contextlib
 import datetime
 import getpass
+import itertools
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.sql
+import select
 import sys
+import threading
 
 
 psycopg2.extras.register_uuid()
@@ -39,6 +44,24 @@ class Connection:
         self._conn_string = conn_string
         self._connection = None
 
+    @classmethod
+    def from_connection(cls, connection) -> 'Connection':
+        """Wraps an already established psycopg2 connection, whose search
+        path is expected to be set already. Closing the connection remains
+        the responsibility of the caller.
+
+        Args:
+            connection: psycopg2 connection
+
+        Returns:
+            Connected connection object"""
+        wrapper = cls.__new__(cls)
+        wrapper._conn_string = None
+        wrapper._connection = connection
+        wrapper._cursor = connection.cursor(
+            cursor_factory=psycopg2.extras.RealDictCursor)
+        return wrapper
+
     def connect(self):
         """Connect to the database"""
         if self._connection is not None:
@@ -63,7 +86,8 @@ class Connection:
                  hmrids: Optional[list[str]] = None,
                  mrids: Optional[list[str]] = None,
                  pmrids: Optional[list[str]] = None,
-                 rnamelikes: Optional[str] = None
+                 rnamelikes: Optional[str] = None,
+                 projection: Optional[dict[str, list[str]]] = None
                  ) -> list:
         """Searches CIM records using given arguments
 
@@ -76,61 +100,190 @@ class Connection:
             mrids: mrids
             pmrids: pmrids
             rnamelikes: rnamelikes
+            projection: mapping CIM class name -> list of attributes. If
+                set, ``fullobject`` of records of the given classes contains
+                only the listed attributes, extracted on the database side,
+                with ``None`` values for attributes the record doesn't have.
+                Records of classes not in the mapping are returned whole
 
         Returns:
             List of rows
         """
-        if not self._connection:
-            raise Exception('not connected to the database')
+        self._cursor.execute(*_recordat_query(
+            self, last_branch_id, last_commit_id, last_valid_time,
+            cim_class_ids, hmrids, mrids, pmrids, rnamelikes, projection))
+        return self._cursor.fetchall()
 
-        if last_valid_time is not None:
-            last_valid_time = last_valid_time.astimezone(datetime.timezone.utc)
-            last_valid_time = last_valid_time.replace(tzinfo=None)
+    def recordat_stream(self,
+                        last_branch_id: Optional[int] = None,
+                        last_commit_id: Optional[int] = None,
+                        last_valid_time: Optional[datetime.datetime] = None,
+                        cim_class_ids: Optional[list[int]] = None,
+                        hmrids: Optional[list[str]] = None,
+                        mrids: Optional[list[str]] = None,
+                        pmrids: Optional[list[str]] = None,
+                        rnamelikes: Optional[str] = None,
+                        projection: Optional[dict[str, list[str]]] = None,
+                        itersize: int = 2000
+                        ) -> Iterator[dict]:
+        """Searches CIM records like :meth:`recordat`, but streams the
+        result using a server-side cursor instead of fetching all rows at
+        once. Only ``itersize`` rows are held in memory at a time. The
+        connection must not be used for other queries until the generator
+        is exhausted or closed.
 
-        self._cursor.execute(
-            "SELECT mrid, rname, cimclassid, cimclass, pmrid, fullobject "
-            "FROM repo.recordat(%s, %s, %s, %s, %s, %s, %s, %s);",
-            (last_branch_id, last_commit_id, last_valid_time,
-             cim_class_ids, hmrids, mrids, pmrids, rnamelikes))
-        return self._cursor.fetchall()
+        Args:
+            last_branch_id: last branch id
+            last_commit_id: last commit id
+            last_valid_time: last valid time - if not already, converted to UTC
+            cim_class_ids: cim class ids
+            hmrids: hmrids
+            mrids: mrids
+            pmrids: pmrids
+            rnamelikes: rnamelikes
+            projection: attribute projection, see :meth:`recordat`
+            itersize: number of rows fetched from the server in one round
+                trip
+
+        Yields:
+            Rows
+        """
+        query = _recordat_query(self, last_branch_id, last_commit_id,
+                                last_valid_time, cim_class_ids, hmrids,
+                                mrids, pmrids, rnamelikes, projection)
+        cursor = self._connection.cursor(
+            name=f'recordat_{next(_cursor_ids)}',
+            cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.itersize = itersize
+        try:
+            cursor.execute(*query)
+            yield from cursor
+        finally:
+            cursor.close()
 
     def snapshot(self,
                  last_branch_id: Optional[int],
-                 last_commit_id: Optional[int]) -> dict[str, int]:
-        """Retrieves a CIM snapshot
+                 last_commit_id: Optional[int],
+                 mrids: Optional[list[str]] = None) -> dict[str, int]:
+        """Retrieves a CIM snapshot. If an mRID has multiple states recorded,
+        the one from the latest commit is used.
 
         Args:
-            branch_id: branch id
-            commit_id: commit id
+            last_branch_id: last branch id
+            last_commit_id: last commit id
+            mrids: if set, only states of the given mRIDs are retrieved
 
         Returns:
             Mapping MRID -> state
         """
+        if not self._connection:
+            raise Exception('not connected to the database')
+
+        conditions = []
+        args = []
+        if last_branch_id is not None:
+            conditions.append('t.branchid <= %s')
+            args.append(last_branch_id)
+        if last_commit_id is not None:
+            conditions.append('t.commitid <= %s')
+            args.append(last_commit_id)
+        if mrids is not None:
+            if not mrids:
+                return {}
+            conditions.append('t.mrids && %s::uuid[]')
+            conditions.append('s.mrid = ANY(%s::uuid[])')
+            args.extend([list(mrids), list(mrids)])
+        where_clause = ''
+        if conditions:
+            where_clause = f"WHERE {' AND '.join(conditions)}"
+
+        with self._connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT DISTINCT ON (s.mrid) s.mrid::text, s.value "
+                f"FROM repo.snapshot_t t, "
+                f"unnest(t.mrids, t.intvalues) AS s(mrid, value) "
+                f"{where_clause} "
+                f"ORDER BY s.mrid, t.commitid DESC, t.branchid DESC;",
+                args)
+            return dict(cursor.fetchall())
+
+    def latest_commit(self,
+                      last_branch_id: Optional[int] = None,
+                      last_commit_id: Optional[int] = None
+                      ) -> Optional[tuple[int, int]]:
+        """Finds the latest commit that recorded a snapshot
+
+        Args:
+            last_branch_id: if set, only commits up to this branch id are
+                considered
+            last_commit_id: if set, only commits up to this commit id are
+                considered
+
+        Returns:
+            Pair of branch id and commit id, or ``None`` if there are no
+            snapshots"""
+        if not self._connection:
+            raise Exception('not connected to the database')
 
+        conditions = []
+        args = []
+        if last_branch_id is not None:
+            conditions.append('branchid <= %s')
+            args.append(last_branch_id)
+        if last_commit_id is not None:
+            conditions.append('commitid <= %s')
+            args.append(last_commit_id)
         where_clause = ''
-        where_args = []
-        if last_branch_id:
-            where_clause += 'branchid <= %s '
-            where_args.append(last_branch_id)
-        if last_commit_id:
-            if where_clause:
-                where_clause += 'AND '
-            where_clause += 'commitid <= %s '
-            where_args.append(last_commit_id)
-        if where_clause:
-            where_clause = f"WHERE {where_clause}"
-
-        self._cursor.execute(
-            f"SELECT mrids, intvalues FROM repo.snapshot_t {where_clause};",
-            where_args)
-        data = self._cursor.fetchall()
-        if not data:
-            return {}
-        snapshot = {}
-        for row in data:
-            for mrid, value in zip(row['mrids'], row['intvalues']):
-                snapshot[str(mrid)] = value
-        return snapshot
+        if conditions:
+            where_clause = f"WHERE {' AND '.join(conditions)} "
+
+        with self._connection.cursor() as cursor:
+            cursor.execute(f"SELECT branchid, commitid "
+                           f"FROM repo.snapshot_t "
+                           f"{where_clause}"
+                           f"ORDER BY commitid DESC, branchid DESC "
+                           f"LIMIT 1;",
+                           args)
+            row = cursor.fetchone()
+        return None if row is None else tuple(row)
+
+    def listen(self, channel: str):
+        """Subscribes to notifications on the given channel. Switches the
+        connection to autocommit mode, so notifications are delivered
+        without ending transactions.
+
+        Args:
+            channel: notification channel name"""
+        if not self._connection:
+            raise Exception('not connected to the database')
+
+        self._connection.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self._connection.cursor() as cursor:
+            cursor.execute(psycopg2.sql.SQL("LISTEN {};").format(
+                psycopg2.sql.Identifier(channel)))
+
+    def notifications(self, timeout: Optional[float] = None) -> list[str]:
+        """Waits for notifications on the channels subscribed to with
+        :meth:`listen`
+
+        Args:
+            timeout: maximum number of seconds to wait, waits indefinitely
+                if ``None``
+
+        Returns:
+            Payloads of received notifications, empty if the wait timed
+            out"""
+        if not self._connection:
+            raise Exception('not connected to the database')
+
+        connection = self._connection
+        if not connection.notifies:
+            select.select([connection], [], [], timeout)
+        connection.poll()
+        payloads = [notify.payload for notify in connection.notifies]
+        connection.notifies.clear()
+        return payloads
 
     def get_classes(self) -> list:
         """Fetch all classes in the database
@@ -146,12 +299,155 @@ class Connection:
         return self._cursor.fetchall()
 
 
+class ConnectionPool:
+
+    """Thread-safe pool of database connections. Every checked out connection
+    gets its own cursor, so connections can be used from multiple threads
+    concurrently, each thread using its own connection. Connections are
+    opened when there is no idle one to check out, with their search path set
+    once, and are kept idle after being returned, so up to ``max_size``
+    connections are reused. Broken connections are discarded and replaced
+    with new ones.
+
+    Args:
+        dbname: database name
+        host: database host
+        port: database port
+        user: database user
+        password: database password, if ``None`` requires input
+        min_size: number of connections opened upon initialization
+        max_size: maximum number of open connections, when all of them are
+            checked out, further checkouts wait until one is returned"""
+
+    def __init__(self,
+                 dbname: str,
+                 host: str = '127.0.0.1',
+                 port: int = 5432,
+                 user: Optional[str] = 'postgres',
+                 password: Optional[str] = None,
+                 min_size: int = 1,
+                 max_size: int = 10):
+        if password is None:
+            password = getpass.getpass(f'Password for Postgres user {user}: ')
+        self._connect_args = dict(host=host, port=port, password=password,
+                                  user=user, dbname=dbname)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []
+        self._closed = False
+        self._lock = threading.Lock()
+        for _ in range(min(min_size, max_size)):
+            self._idle.append(self._open())
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager that checks out a connection from the pool and
+        returns it once the block exits. If the block raises a database
+        connection error, the connection is closed instead of being returned
+        to the pool.
+
+        Yields:
+            :class:`Connection`"""
+        with self._slots:
+            raw = self._checkout()
+            connection = Connection.from_connection(raw)
+            broken = False
+            try:
+                yield connection
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                if not raw.closed:
+                    connection._cursor.close()
+                self._return(raw, broken)
+
+    def close(self):
+        """Close all pooled connections"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for raw in idle:
+            raw.close()
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise Exception('connection pool is closed')
+                raw = self._idle.pop() if self._idle else None
+            if raw is None:
+                return self._open()
+            if not raw.closed:
+                return raw
+
+    def _return(self, raw, broken):
+        if not broken and not raw.closed:
+            status = raw.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                broken = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    raw.rollback()
+                except psycopg2.Error:
+                    broken = True
+        with self._lock:
+            keep = not broken and not raw.closed and not self._closed
+            if keep:
+                self._idle.append(raw)
+        if not keep and not raw.closed:
+            raw.close()
+
+    def _open(self):
+        raw = psycopg2.connect(**self._connect_args)
+        try:
+            with raw.cursor() as cursor:
+                cursor.execute("SET search_path TO repo;")
+            raw.commit()
+        except psycopg2.Error:
+            raw.close()
+            raise
+        return raw
+
+
+_cursor_ids = itertools.count()
+
+
+def _recordat_query(connection, last_branch_id, last_commit_id,
+                    last_valid_time, cim_class_ids, hmrids, mrids, pmrids,
+                    rnamelikes, projection):
+    if not connection._connection:
+        raise Exception('not connected to the database')
+
+    if last_valid_time is not None:
+        last_valid_time = last_valid_time.astimezone(datetime.timezone.utc)
+        last_valid_time = last_valid_time.replace(tzinfo=None)
+
+    fullobject = 'fullobject'
+    projection_args = []
+    if projection:
+        cases = []
+        for cim_class, attributes in projection.items():
+            pairs = ', '.join(['%s, fullobject->%s'] * len(attributes))
+            cases.append(f'WHEN %s THEN jsonb_build_object({pairs})')
+            projection_args.append(cim_class)
+            for attribute in attributes:
+                projection_args.extend([attribute, attribute])
+        fullobject = (f"CASE cimclass {' '.join(cases)} "
+                      f"ELSE fullobject END AS fullobject")
+
+    return (f"SELECT mrid, rname, cimclassid, cimclass, pmrid, {fullobject} "
+            f"FROM repo.recordat(%s, %s, %s, %s, %s, %s, %s, %s);",
+            (*projection_args, last_branch_id, last_commit_id,
+             last_valid_time, cim_class_ids, hmrids, mrids, pmrids,
+             rnamelikes))
+
+
 @contextlib.contextmanager
 def connect(dbname: str,
-            host: str,
-            port: int,
-            user: Optional[str],
-            password: Optional[str]):
+            host: str = '127.0.0.1',
+            port: int = 5432,
+            user: Optional[str] = 'postgres',
+            password: Optional[str] = None):
     """Context manager for a database connection
 
     Args:
@@ -160,10 +456,12 @@ def connect(dbname: str,
         port: database port
         user: database user
         password: database password"""
-    connection = Connection(dbname)
+    connection = Connection(dbname, host, port, user, password)
     connection.connect()
-    yield connection
-    connection.disconnect()
+    try:
+        yield connection
+    finally:
+        connection.disconnect()
 
 
 @click.command()
@@ -1,83 +1,472 @@
-import attest.topology.db
+from pathlib import Path
+from typing import Optional
+import attest.topology.compact
 import attest.topology.node_breaker
 import attest.topology.unprocessed
 import click
-import datetime
+import concurrent.futures
+import numpy
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
 import sys
 
 
+orderings = ('lexicographic', 'rcm', 'minimum_degree')
+"""Supported topological node orderings:
+
+    * ``lexicographic`` - by topological node mRID\n
+    * ``rcm`` - reverse Cuthill-McKee, reduces matrix bandwidth\n
+    * ``minimum_degree`` - multiple minimum degree on the matrix structure,
+      reduces fill-in of matrix factorization\n
+"""
+
+
+class Island:
+
+    """Electrical island - a connected group of topological nodes, with its
+    own admittance matrix
+
+    Args:
+        buses: admittance matrix indices of the island's nodes in the
+            node-branch model, ascending
+        topological_nodes: island's topological nodes, in island admittance
+            matrix order
+        admittance_matrix: island admittance matrix, sub-matrix of the
+            node-branch model admittance matrix"""
+
+    def __init__(self,
+                 buses: numpy.ndarray,
+                 topological_nodes: list,
+                 admittance_matrix: scipy.sparse.csr_matrix):
+        self._buses = buses
+        self._topological_nodes = topological_nodes
+        self._admittance_matrix = admittance_matrix
+
+    @property
+    def buses(self) -> numpy.ndarray:
+        """Admittance matrix indices of the island's nodes in the
+        node-branch model"""
+        return self._buses
+
+    @property
+    def topological_nodes(self) -> list:
+        """Topological nodes, in island admittance matrix order"""
+        return self._topological_nodes
+
+    @property
+    def admittance_matrix(self) -> scipy.sparse.csr_matrix:
+        """Island admittance matrix, in sparse CSR format"""
+        return self._admittance_matrix
+
+
 class NodeBranchModel:
 
     """Node-branch model based on the given node-breaker model. Starts
     processing upon initialziation
 
     Args:
-        node_breaker: node-breaker model"""
+        node_breaker: node-breaker model
+        collapse_lines: if ``True``, chains of series line segments are
+            collapsed into single lines, removing the pass-through
+            topological nodes between them (see :attr:`line_chains`)
+        ordering: topological node ordering, one of :data:`orderings`"""
 
-    def __init__(self, node_breaker):
+    def __init__(self,
+                 node_breaker,
+                 collapse_lines: bool = False,
+                 ordering: str = 'lexicographic'):
+        if ordering not in orderings:
+            raise ValueError(f'unsupported ordering {ordering}')
         self._node_breaker = node_breaker
-        self._topological_nodes = _ordered_nodes(
-            node_breaker.topological_nodes)
+        self._collapse_lines = collapse_lines
+        self._ordering = ordering
+        self._reset_views()
+        self._calculate()
 
-        admittance_matrix = _calculate_admittance_matrix(node_breaker)
-        self._admittance_matrix = admittance_matrix
+    @property
+    def ordering(self) -> str:
+        """Topological node ordering"""
+        return self._ordering
 
     @property
-    def admittance_matrix(self):
-        """Model admittance matrix"""
-        return self._admittance_matrix
+    def permutation(self) -> numpy.ndarray:
+        """Admittance matrix permutation - lexicographic index of every
+        topological node, in admittance matrix order. Calculated on first
+        access"""
+        if self._permutation is None:
+            self._permutation = _permutation(self._admittance_matrix,
+                                             self._ordering)
+        return self._permutation
+
+    @property
+    def admittance_matrix(self) -> scipy.sparse.csr_matrix:
+        """Model admittance matrix, in sparse CSR format"""
+        if self._ordering == 'lexicographic':
+            return self._admittance_matrix
+        if self._ordered_admittance_matrix is None:
+            permutation = self.permutation
+            self._ordered_admittance_matrix = self._admittance_matrix[
+                permutation][:, permutation].tocsr()
+        return self._ordered_admittance_matrix
+
+    @property
+    def dense_admittance_matrix(self) -> numpy.ndarray:
+        """Model admittance matrix as a dense array, built on first access"""
+        if self._dense_admittance_matrix is None:
+            self._dense_admittance_matrix = self.admittance_matrix.toarray()
+        return self._dense_admittance_matrix
 
     @property
     def topological_nodes(self):
-        """Topological nodes"""
+        """Topological nodes, in admittance matrix order"""
+        if self._topological_nodes is None:
+            topological_nodes = self._ordered_nodes()
+            self._topological_nodes = [topological_nodes[i] for i
+                                       in self.permutation.tolist()]
         return self._topological_nodes
 
+    @property
+    def island_labels(self) -> numpy.ndarray:
+        """Island index of every topological node, in admittance matrix
+        order. Islands are numbered in order of their first node. Calculated
+        on first access"""
+        if self._island_labels is None:
+            _, self._island_labels = scipy.sparse.csgraph.connected_components(
+                self.admittance_matrix != 0, directed=False)
+        return self._island_labels
+
+    def islands(self, workers: Optional[int] = None) -> list[Island]:
+        """Splits the model into electrical islands. Since there are no
+        admittances between islands, the admittance matrix is block-diagonal
+        in island order and islands can be processed independently.
+
+        Args:
+            workers: number of threads extracting island sub-matrices, if
+                ``None`` or 1, islands are extracted sequentially
+
+        Returns:
+            Islands, in order of :attr:`island_labels`"""
+        labels = self.island_labels
+        order = numpy.argsort(labels, kind='stable')
+        bounds = numpy.concatenate(
+            [[0], numpy.cumsum(numpy.bincount(labels))])
+        matrix = self.admittance_matrix[order][:, order].tocsr()
+        topological_nodes = self.topological_nodes
+
+        def island(i):
+            start, stop = bounds[i], bounds[i + 1]
+            buses = order[start:stop]
+            return Island(buses,
+                          [topological_nodes[j] for j in buses.tolist()],
+                          matrix[start:stop, start:stop])
+
+        if workers is None or workers == 1:
+            return [island(i) for i in range(len(bounds) - 1)]
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(island, range(len(bounds) - 1)))
+
+    @property
+    def line_chains(self) -> list[list[str]]:
+        """ACLineSegment mRIDs of every chain of two or more series segments
+        collapsed into a single line, in order from one end to the other.
+        Empty if lines aren't collapsed"""
+        compact = self._node_breaker.compact
+        return [[compact.mrid(i) for i in chain.tolist()]
+                for chain in self._line_chains]
+
+    @property
+    def collapsed_buses(self) -> numpy.ndarray:
+        """Node indices of pass-through topological nodes removed by
+        collapsing line chains"""
+        return self._collapsed_buses
+
+    @property
+    def buses(self) -> numpy.ndarray:
+        """Node indices (see
+        :attr:`attest.topology.node_breaker.NodeBreakerModel.node_ids`) of
+        topological nodes, in admittance matrix order"""
+        return self._buses[self.permutation]
+
+    def apply_switch_changes(self, changes: dict[str, bool]):
+        """Applies switch state changes to the model. Only the topological
+        nodes connected to the changed switches are split or merged, and only
+        the admittance matrix rows and columns of those nodes are
+        recalculated, the rest of the matrix is carried over. If lines are
+        collapsed, the whole matrix is recalculated.
 
-def _calculate_admittance_matrix(node_breaker):
-    connectivity_inv = {}
-    for k, terminals in node_breaker.connectivity_map.items():
-        for terminal in terminals:
-            connectivity_inv[terminal] = k
-
-    node_count = len(node_breaker.topological_nodes)
-    matrix = [[0] * node_count for _ in range(node_count)]
-    nodes = [node for node, _
-             in _ordered_nodes(node_breaker.topological_nodes)]
-    processed_lines = set()
-    for i, node_mrid in enumerate(nodes):
-        for term_mrid in node_breaker.connectivity_map[node_mrid]:
-            terminal = node_breaker.asset_map[term_mrid]
-
-            line_seg_mrid = terminal['cim:Terminal.ConductingEquipment']
-            line_seg = node_breaker.asset_map.get(line_seg_mrid)
-            if not line_seg or line_seg['cimclass'] != 'cim:ACLineSegment':
-                continue
-            if line_seg_mrid in processed_lines:
-                continue
-            processed_lines.add(line_seg_mrid)
-
-            x = (line_seg['cim:ACLineSegment.x']
-                 or line_seg['cim:ACLineSegment.x0'])
-            r = (line_seg['cim:ACLineSegment.r']
-                 or line_seg['cim:ACLineSegment.r0'])
-            gch = (line_seg['cim:ACLineSegment.gch']
-                   or line_seg['cim:ACLineSegment.g0ch'])
-            bch = (line_seg['cim:ACLineSegment.bch']
-                   or line_seg['cim:ACLineSegment.b0ch'])
-            denominator = r ** 2 + x ** 2
-            if denominator == 0:
-                continue
-            admittance = complex(r / denominator, - x / denominator)
-            shunt = complex(gch / 2, bch / 2)
-
-            other_term_mrid = [t for t
-                               in node_breaker.terminal_map[line_seg_mrid]
-                               if t != term_mrid][0]
-            other_node = connectivity_inv[other_term_mrid]
-            j = nodes.index(other_node)
-
-            matrix[i][j] = -admittance
-            matrix[i][i] += admittance + shunt
+        Args:
+            changes: mapping switch mRID -> new state, ``True`` if closed"""
+        removed, added = self._node_breaker.apply_switch_changes(changes)
+        if not len(removed) and not len(added):
+            return
+        self._reset_views()
+        if self._collapse_lines:
+            self._calculate()
+            return
+
+        kept_mask = ~numpy.isin(self._buses, removed)
+        kept_old_indices = numpy.flatnonzero(kept_mask)
+        kept = self._buses[kept_mask]
+        buses = numpy.union1d(kept, added)
+        node_count = len(buses)
+        kept_new_indices = numpy.searchsorted(buses, kept)
+
+        kept_matrix = self._admittance_matrix[kept_old_indices][
+            :, kept_old_indices].tocoo()
+        kept_matrix = scipy.sparse.coo_matrix(
+            (kept_matrix.data, (kept_new_indices[kept_matrix.row],
+                                kept_new_indices[kept_matrix.col])),
+            shape=(node_count, node_count))
+
+        diagonal_nodes = numpy.isin(buses, added)
+        first_nodes, second_nodes, parameters, _ = _line_arrays(
+            self._node_breaker, buses)
+        changed = diagonal_nodes[first_nodes] | diagonal_nodes[second_nodes]
+        changed_matrix = _assemble_admittance_matrix(
+            node_count, first_nodes[changed], second_nodes[changed],
+            parameters[changed], diagonal_nodes)
+
+        matrix = (kept_matrix.tocsr() + changed_matrix).tocsr()
+        matrix.eliminate_zeros()
+        self._buses = buses
+        self._admittance_matrix = matrix
+
+    def _reset_views(self):
+        self._permutation = None
+        self._ordered_admittance_matrix = None
+        self._topological_nodes = None
+        self._dense_admittance_matrix = None
+        self._island_labels = None
+
+    def _calculate(self):
+        buses = numpy.unique(self._node_breaker.merge_indices)
+        first_nodes, second_nodes, parameters, line_ids = _line_arrays(
+            self._node_breaker, buses)
+        if self._collapse_lines:
+            (buses, first_nodes, second_nodes, parameters, self._line_chains,
+             self._collapsed_buses) = _collapse_line_chains(
+                self._node_breaker, buses, first_nodes, second_nodes,
+                parameters, line_ids)
+        else:
+            self._line_chains = []
+            self._collapsed_buses = numpy.array([], dtype=numpy.int64)
+        self._buses = buses
+        self._admittance_matrix = _assemble_admittance_matrix(
+            len(buses), first_nodes, second_nodes, parameters)
+
+    def _ordered_nodes(self):
+        topological_nodes = self._node_breaker.topological_nodes
+        if len(self._collapsed_buses):
+            compact = self._node_breaker.compact
+            node_ids = self._node_breaker.node_ids
+            collapsed = {compact.mrid(i) for i in
+                         node_ids[self._collapsed_buses].tolist()}
+            topological_nodes = {node: elements for node, elements
+                                 in topological_nodes.items()
+                                 if node not in collapsed}
+        return _ordered_nodes(topological_nodes)
+
+
+def _permutation(matrix, ordering):
+    node_count = matrix.shape[0]
+    if ordering == 'lexicographic' or node_count == 0:
+        return numpy.arange(node_count)
+
+    structure = (matrix != 0).astype(float).tocsr()
+    structure.setdiag(0)
+    structure.eliminate_zeros()
+    if ordering == 'rcm':
+        return scipy.sparse.csgraph.reverse_cuthill_mckee(
+            structure, symmetric_mode=True).astype(numpy.int64)
+
+    # factorization of a diagonally dominant matrix with the admittance
+    # matrix structure, only used for its column ordering
+    degrees = numpy.asarray(structure.sum(axis=1)).ravel()
+    dominant = (scipy.sparse.diags(degrees + 1) - structure).tocsc()
+    factorization = scipy.sparse.linalg.splu(
+        dominant, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0,
+        options={'SymmetricMode': True})
+    return numpy.argsort(factorization.perm_c).astype(numpy.int64)
+
+
+def _calculate_admittance_matrix(node_breaker, buses=None,
+                                 collapse_lines=False):
+    if buses is None:
+        buses = numpy.unique(node_breaker.merge_indices)
+    first_nodes, second_nodes, parameters, line_ids = _line_arrays(
+        node_breaker, buses)
+    if collapse_lines:
+        buses, first_nodes, second_nodes, parameters, _, _ = \
+            _collapse_line_chains(node_breaker, buses, first_nodes,
+                                  second_nodes, parameters, line_ids)
+    return _assemble_admittance_matrix(len(buses), first_nodes,
+                                       second_nodes, parameters)
+
+
+def _line_arrays(node_breaker, buses):
+    """Collects end bus indices, parameters and ids of all lines whose both
+    ends are connected to a topological node"""
+    compact = node_breaker.compact
+    indptr, indices = compact.equipment_terminals
+    line_ids = compact.line_ids
+    two_terminals = (indptr[line_ids + 1] - indptr[line_ids]) == 2
+    starts = indptr[line_ids[two_terminals]]
+
+    bus_indices = numpy.full(len(node_breaker.node_ids), -1,
+                             dtype=numpy.int64)
+    bus_indices[buses] = numpy.arange(len(buses))
+
+    def line_ends(terminals):
+        ends = numpy.full(len(terminals), -1, dtype=numpy.int64)
+        node_ids = compact.terminal_node[terminals]
+        connected = node_ids >= 0
+        nodes = node_breaker.node_indices[node_ids[connected]]
+        ends[numpy.flatnonzero(connected)[nodes >= 0]] = bus_indices[
+            node_breaker.merge_indices[nodes[nodes >= 0]]]
+        return ends
+
+    first_nodes = line_ends(indices[starts])
+    second_nodes = line_ends(indices[starts + 1])
+    valid = (first_nodes >= 0) & (second_nodes >= 0)
+    return (first_nodes[valid], second_nodes[valid],
+            compact.line_parameters[two_terminals][valid],
+            line_ids[two_terminals][valid])
+
+
+def _collapse_line_chains(node_breaker, buses, first_nodes, second_nodes,
+                          parameters, line_ids):
+    """Replaces chains of series lines with single lines. A bus is
+    pass-through if it has exactly two terminals (not counting closed
+    switches), both belonging to different lines from the line arrays.
+    Chain's resistance, reactance and shunt values are sums of its lines'
+    values. Pass-through buses forming a closed ring are kept.
+
+    Returns:
+        Tuple of remaining buses, line arrays (first nodes, second nodes,
+        parameters) with chains replaced, chains as arrays of line ids and
+        node indices of removed buses"""
+    bus_count = len(buses)
+    terminal_counts = _terminal_counts(node_breaker, buses)
+    line_degrees = (numpy.bincount(first_nodes, minlength=bus_count)
+                    + numpy.bincount(second_nodes, minlength=bus_count))
+    self_loops = first_nodes[first_nodes == second_nodes]
+    pass_through = (terminal_counts == 2) & (line_degrees == 2)
+    pass_through[self_loops] = False
+
+    touching = pass_through[first_nodes] | pass_through[second_nodes]
+    chain_lines = numpy.flatnonzero(touching)
+    incident = {}
+    for line in chain_lines.tolist():
+        for bus in (first_nodes[line], second_nodes[line]):
+            if pass_through[bus]:
+                incident.setdefault(int(bus), []).append(line)
+
+    visited = set()
+    chains = []
+    chain_ends = []
+    for line in chain_lines.tolist():
+        if line in visited:
+            continue
+        if not pass_through[first_nodes[line]]:
+            start = int(first_nodes[line])
+        elif not pass_through[second_nodes[line]]:
+            start = int(second_nodes[line])
+        else:
+            continue
+        chain = [line]
+        visited.add(line)
+        bus = _other_end(first_nodes, second_nodes, line, start)
+        while pass_through[bus]:
+            first, second = incident[bus]
+            line = second if first == line else first
+            chain.append(line)
+            visited.add(line)
+            bus = _other_end(first_nodes, second_nodes, line, bus)
+        chains.append(chain)
+        chain_ends.append((start, bus))
+
+    ring_lines = numpy.setdiff1d(chain_lines,
+                                 numpy.array(sorted(visited), dtype=int))
+    pass_through[first_nodes[ring_lines]] = False
+    pass_through[second_nodes[ring_lines]] = False
+
+    kept_lines = numpy.flatnonzero(~touching)
+    kept_lines = numpy.concatenate([kept_lines, ring_lines])
+    values = attest.topology.compact.line_values(parameters)
+    chain_parameters = numpy.full((len(chains), parameters.shape[1]),
+                                  numpy.nan)
+    chain_parameters[:, :values.shape[1]] = numpy.array(
+        [values[chain].sum(axis=0) for chain in chains]
+    ).reshape(-1, values.shape[1])
+    chain_first, chain_second = numpy.array(chain_ends,
+                                            dtype=numpy.int64).reshape(-1, 2).T
+
+    bus_indices = numpy.cumsum(~pass_through) - 1
+    first_nodes = bus_indices[numpy.concatenate([first_nodes[kept_lines],
+                                                 chain_first])]
+    second_nodes = bus_indices[numpy.concatenate([second_nodes[kept_lines],
+                                                  chain_second])]
+    parameters = numpy.concatenate([parameters[kept_lines], chain_parameters])
+    return (buses[~pass_through], first_nodes, second_nodes, parameters,
+            [line_ids[chain] for chain in chains if len(chain) > 1],
+            buses[pass_through])
+
+
+def _terminal_counts(node_breaker, buses):
+    """Counts terminals of every bus, excluding terminals of closed
+    switches"""
+    compact = node_breaker.compact
+    bus_indices = numpy.full(len(node_breaker.node_ids), -1,
+                             dtype=numpy.int64)
+    bus_indices[buses] = numpy.arange(len(buses))
+
+    owners, terminals = attest.topology.compact.csr_rows(
+        compact.node_terminals, node_breaker.node_ids)
+    equipment = compact.terminal_equipment[terminals]
+    closed_switch = numpy.zeros(len(terminals), dtype=bool)
+    has_equipment = equipment >= 0
+    closed_switch[has_equipment] = compact.switch_states[
+        equipment[has_equipment]]
+    owner_buses = bus_indices[node_breaker.merge_indices[
+        node_breaker.node_indices[owners]]]
+    return numpy.bincount(owner_buses[~closed_switch],
+                          minlength=len(buses))
+
+
+def _other_end(first_nodes, second_nodes, line, bus):
+    first = int(first_nodes[line])
+    return int(second_nodes[line]) if first == bus else first
+
+
+def _assemble_admittance_matrix(node_count, first_nodes, second_nodes,
+                                parameters, diagonal_nodes=None):
+    """Builds the admittance matrix from line arrays - end node indices and a
+    parameter table in :attr:`attest.topology.compact.CompactModel.
+    line_parameters` format. If ``diagonal_nodes`` mask is given, diagonal
+    values are accumulated only for the masked nodes"""
+    r, x, gch, bch = attest.topology.compact.line_values(parameters).T
+
+    denominator = r ** 2 + x ** 2
+    valid = denominator != 0
+    admittance = (r[valid] - 1j * x[valid]) / denominator[valid]
+    shunt = (gch[valid] + 1j * bch[valid]) / 2
+    first_nodes = first_nodes[valid]
+    second_nodes = second_nodes[valid]
+
+    diagonal = numpy.zeros(node_count, dtype=complex)
+    numpy.add.at(diagonal, first_nodes, admittance + shunt)
+    numpy.add.at(diagonal, second_nodes, admittance + shunt)
+    if diagonal_nodes is not None:
+        diagonal[~diagonal_nodes] = 0
+
+    diagonal_indices = numpy.arange(node_count)
+    rows = numpy.concatenate([diagonal_indices, first_nodes, second_nodes])
+    cols = numpy.concatenate([diagonal_indices, second_nodes, first_nodes])
+    values = numpy.concatenate([diagonal, -admittance, -admittance])
+    matrix = scipy.sparse.coo_matrix(
+        (values, (rows, cols)), shape=(node_count, node_count)).tocsr()
+    matrix.eliminate_zeros()
     return matrix
 
 
@@ -87,18 +476,26 @@ def _ordered_nodes(topological_nodes):
 
 
 @click.command()
-@click.option('--dbname', help='name of the cim database', required=True)
-def main(dbname):
-    unprocessed = attest.unprocessed.UnprocessedModel()
-    with attest.db.connect(dbname) as c:
-        unprocessed.load_data_structures(c, 4, 1, datetime.datetime.now())
-
-    topological_nodes, connectivity_map = attest.node_breaker.merge_nodes(
-        unprocessed)
-    node_breaker = attest.node_breaker.NodeBreakerModel(
-        unprocessed, topological_nodes, connectivity_map)
-
-    print(_calculate_admittance_matrix(node_breaker))
+@click.option('--dbname', help='name of the cim database')
+@click.option('--model-path', type=Path,
+              help='stored model directory, used instead of the database')
+@click.option('--collapse-lines', is_flag=True,
+              help='collapse chains of series line segments')
+@click.option('--islands', is_flag=True,
+              help='print admittance matrices of electrical islands')
+def main(dbname, model_path, collapse_lines, islands):
+    model = attest.topology.compact.load(dbname, model_path)
+    node_breaker = attest.topology.node_breaker.NodeBreakerModel(model)
+
+    if not islands:
+        print(_calculate_admittance_matrix(
+            node_breaker, collapse_lines=collapse_lines).toarray())
+        return
+
+    node_branch = NodeBranchModel(node_breaker, collapse_lines=collapse_lines)
+    for island in node_branch.islands():
+        print([node_mrid for node_mrid, _ in island.topological_nodes])
+        print(island.admittance_matrix.toarray())
 
 
 if __name__ == '__main__':
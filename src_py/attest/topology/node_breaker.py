@@ -1,111 +1,248 @@
 """Module containing the implementation for building the node-breaker model."""
-import attest.topology.db
+from pathlib import Path
+from typing import Optional, Union
+import attest.topology.compact
 import attest.topology.unprocessed
 import click
-import datetime
+import numpy
 import sys
 
 
 class NodeBreakerModel:
 
     """Node-breaker model based on the given unprocessed model. Starts
-    processing upon initialization
+    processing upon initialization. Processing runs on the compact model - if
+    an unprocessed model is given, it is converted first.
 
     Args:
-        unprocessed: unprocessed model"""
+        unprocessed: unprocessed or compact model"""
 
     def __init__(self,
-                 unprocessed: attest.topology.unprocessed.UnprocessedModel):
-        self._unprocessed = unprocessed
-
-        topological_nodes, connectivity_map = _merge_nodes(unprocessed)
-        self._topological_nodes = topological_nodes
-        self._connectivity_map = connectivity_map
+                 unprocessed: Union[
+                     attest.topology.unprocessed.UnprocessedModel,
+                     attest.topology.compact.CompactModel]):
+        if isinstance(unprocessed, attest.topology.compact.CompactModel):
+            self._unprocessed = None
+            compact = unprocessed
+        else:
+            self._unprocessed = unprocessed
+            compact = attest.topology.compact.CompactModel.from_unprocessed(
+                unprocessed)
+        self._compact = compact
+
+        node_ids = compact.node_ids
+        self._node_ids = node_ids[numpy.argsort(compact.mrids[node_ids],
+                                                kind='stable')]
+        self._node_indices = numpy.full(compact.size, -1, dtype=numpy.int64)
+        self._node_indices[self._node_ids] = numpy.arange(len(node_ids))
+        self._merge_indices = _merge_nodes(compact, self._node_indices,
+                                           len(node_ids))
+        self._topological_nodes = None
 
     @property
-    def topological_nodes(self):
-        """Topological nodes"""
-        return self._topological_nodes
+    def compact(self) -> attest.topology.compact.CompactModel:
+        """Compact model the processing runs on"""
+        return self._compact
 
     @property
-    def connectivity_map(self):
-        """Connectivity map"""
-        return self._connectivity_map
+    def node_ids(self) -> numpy.ndarray:
+        """Compact model ids of all connectivity nodes, ordered by mRID.
+        Positions in this array are referred to as node indices."""
+        return self._node_ids
 
     @property
-    def terminal_map(self):
-        """Terminal map"""
-        return self._unprocessed.terminal_map
+    def node_indices(self) -> numpy.ndarray:
+        """Compact model id -> node index, ``-1`` for other elements"""
+        return self._node_indices
 
     @property
-    def asset_map(self):
-        """Asset map"""
-        return self._unprocessed.asset_map
+    def merge_indices(self) -> numpy.ndarray:
+        """Merge map in array form - node index -> index of the node it is
+        merged into"""
+        return self._merge_indices
 
     @property
-    def switch_map(self):
-        """Switch map"""
-        return self._unprocessed.switch_map
-
-
-def _merge_nodes(unprocessed):
-    connectivity_map = {mrid: list(terminals) for mrid, terminals
-                        in unprocessed.connectivity_map.items()}
-    merge_map = {node['mrid']: node['mrid'] for node in unprocessed.node_set}
-    topological_nodes = {}
-
-    for node in sorted(unprocessed.node_set, key=lambda n: n['mrid']):
-        connected_nodes = set([merge_map[node['mrid']]])
-        for terminal_mrid in connectivity_map[node['mrid']]:
-            terminal = unprocessed.asset_map[terminal_mrid]
-            switch_mrid = terminal['cim:Terminal.ConductingEquipment']
-
-            switch = unprocessed.asset_map.get(switch_mrid)
-            if switch is None:
-                continue
-
-            if switch['cimclass'] not in ('cim:Breaker', 'cim:Disconnector'):
-                continue
+    def topological_nodes(self) -> dict[str, set[str]]:
+        """Topological nodes, built on access"""
+        if self._topological_nodes is None:
+            self._topological_nodes = {
+                self._mrid(final): {self._mrid(i) for i in group}
+                for final, group in _groups(self._merge_indices)}
+        return self._topological_nodes
 
-            if not unprocessed.switch_map[switch['mrid']]:
-                continue
+    @property
+    def connectivity_map(self) -> dict[str, list[str]]:
+        """Connectivity map, built on access"""
+        indptr, indices = self._compact.node_terminals
+        connectivity_map = {self._mrid(i): []
+                            for i in range(len(self._node_ids))}
+        for final, group in _groups(self._merge_indices):
+            terminals = connectivity_map[self._mrid(final)]
+            for node_id in self._node_ids[group].tolist():
+                terminals.extend(self._compact.mrid(t) for t in
+                                 indices[indptr[node_id]:indptr[node_id + 1]])
+        return connectivity_map
 
-            other_term_mrid = [t for t
-                               in unprocessed.terminal_map[switch['mrid']]
-                               if t != terminal_mrid][0]
-            other_term = unprocessed.asset_map[other_term_mrid]
-            other_node_mrid = other_term['cim:Terminal.ConnectivityNode']
-            connected_nodes.add(other_node_mrid)
+    @property
+    def merge_map(self) -> dict[str, str]:
+        """Merge map, connectivity node mRID -> topological node mRID, built
+        on access"""
+        return {self._mrid(i): self._mrid(final)
+                for i, final in enumerate(self._merge_indices.tolist())}
 
-        max_mrid = max(connected_nodes)
-        connectivity_map.setdefault(max_mrid, [])
-        connected_nodes.remove(max_mrid)
-        for mrid in connected_nodes:
-            merge_map[mrid] = max_mrid
-            connectivity_map[max_mrid].extend(connectivity_map.get(mrid, []))
-            connectivity_map[mrid] = []
+    @property
+    def terminal_map(self) -> dict[str, list[str]]:
+        """Terminal map"""
+        if self._unprocessed is not None:
+            return self._unprocessed.terminal_map
+        return self._compact.terminal_map
 
-    for node in unprocessed.node_set[::-1]:
-        if (node['mrid'] not in merge_map
-                or merge_map[node['mrid']] not in merge_map):
-            continue
-        merge_map[node['mrid']] = merge_map[merge_map[node['mrid']]]
+    @property
+    def asset_map(self) -> Optional[dict[str, dict]]:
+        """Asset map, ``None`` if the model was built from a compact model"""
+        if self._unprocessed is None:
+            return None
+        return self._unprocessed.asset_map
 
-    for node_mrid, final_node in merge_map.items():
-        topological_nodes.setdefault(final_node, set())
-        topological_nodes[final_node].add(node_mrid)
+    @property
+    def switch_map(self) -> dict[str, bool]:
+        """Switch map, built on access"""
+        return self._compact.switch_map
+
+    def apply_switch_changes(self,
+                             changes: dict[str, bool]
+                             ) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Applies switch state changes, regrouping only the topological
+        nodes connected to the changed switches
+
+        Args:
+            changes: mapping switch mRID -> new state, ``True`` if closed
+
+        Returns:
+            Pair of sorted node index arrays - topological nodes that were
+            removed and topological nodes that were added. The same index can
+            be in both arrays if the node's content changed"""
+        compact = self._compact
+        changed = compact.set_switch_states(changes)
+        if not len(changed):
+            empty = numpy.array([], dtype=numpy.int64)
+            return empty, empty
+
+        indices = self._switch_node_indices(changed)[1]
+        removed = numpy.unique(self._merge_indices[indices])
+        affected = numpy.flatnonzero(numpy.isin(self._merge_indices,
+                                                removed))
+
+        _, terminals = attest.topology.compact.csr_rows(
+            compact.node_terminals, self._node_ids[affected])
+        equipment = compact.terminal_equipment[terminals]
+        equipment = equipment[equipment >= 0]
+        switches = numpy.unique(equipment[compact.switch_states[equipment]])
+
+        disjoint_set = _DisjointSet(len(affected))
+        owners, indices = self._switch_node_indices(switches)
+        local = numpy.searchsorted(affected, indices)
+        for i, j in _consecutive_pairs(owners, local):
+            disjoint_set.union(i, j)
+        merge_indices = affected[[disjoint_set.highest(i)
+                                  for i in range(len(affected))]]
+
+        self._merge_indices[affected] = merge_indices
+        self._topological_nodes = None
+        return removed, numpy.unique(merge_indices)
+
+    def _mrid(self, i):
+        return self._compact.mrid(self._node_ids[i])
+
+    def _switch_node_indices(self, switch_ids):
+        return _switch_node_indices(self._compact, self._node_indices,
+                                    switch_ids)
+
+
+def _merge_nodes(compact, node_indices, node_count):
+    switch_ids = compact.switch_ids
+    switch_ids = switch_ids[compact.switch_states[switch_ids]]
+    disjoint_set = _DisjointSet(node_count)
+    owners, indices = _switch_node_indices(compact, node_indices, switch_ids)
+    for i, j in _consecutive_pairs(owners, indices):
+        disjoint_set.union(i, j)
+    return numpy.array([disjoint_set.highest(i) for i in range(node_count)],
+                       dtype=numpy.int64)
+
+
+def _switch_node_indices(compact, node_indices, switch_ids):
+    owners, terminals = attest.topology.compact.csr_rows(
+        compact.equipment_terminals, switch_ids)
+    node_ids = compact.terminal_node[terminals]
+    owners, node_ids = owners[node_ids >= 0], node_ids[node_ids >= 0]
+    indices = node_indices[node_ids]
+    return owners[indices >= 0], indices[indices >= 0]
+
+
+def _consecutive_pairs(owners, values):
+    same = owners[1:] == owners[:-1]
+    return zip(values[:-1][same].tolist(), values[1:][same].tolist())
+
+
+def _groups(merge_indices):
+    order = numpy.argsort(merge_indices, kind='stable')
+    finals = merge_indices[order]
+    bounds = numpy.flatnonzero(numpy.diff(finals)) + 1
+    for group in numpy.split(order, bounds):
+        if len(group):
+            yield merge_indices[group[0]], group
+
+
+class _DisjointSet:
+
+    """Union-find structure over integer elements ``0..size-1``, with path
+    compression and union by rank. Every set additionally tracks its highest
+    element, which is used as the merge target.
 
-    return topological_nodes, connectivity_map
+    Args:
+        size: number of elements"""
+
+    def __init__(self, size: int):
+        self._parent = list(range(size))
+        self._rank = [0] * size
+        self._highest = list(range(size))
+
+    def find(self, i: int) -> int:
+        """Find the root element of the set containing ``i``"""
+        root = i
+        parent = self._parent
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def union(self, i: int, j: int):
+        """Merge the sets containing ``i`` and ``j``"""
+        root_i = self.find(i)
+        root_j = self.find(j)
+        if root_i == root_j:
+            return
+        if self._rank[root_i] < self._rank[root_j]:
+            root_i, root_j = root_j, root_i
+        self._parent[root_j] = root_i
+        if self._rank[root_i] == self._rank[root_j]:
+            self._rank[root_i] += 1
+        self._highest[root_i] = max(self._highest[root_i],
+                                    self._highest[root_j])
+
+    def highest(self, i: int) -> int:
+        """Highest element of the set containing ``i``"""
+        return self._highest[self.find(i)]
 
 
 @click.command()
-@click.option('--dbname', help='name of the cim database', required=True)
-def main(dbname):
-    model = attest.unprocessed.UnprocessedModel()
-    with attest.db.connect(dbname) as c:
-        model.load_data_structures(c, 4, 1, datetime.datetime.now())
-    topological_nodes, connectivity_map = _merge_nodes(model)
-    print(topological_nodes)
+@click.option('--dbname', help='name of the cim database')
+@click.option('--model-path', type=Path,
+              help='stored model directory, used instead of the database')
+def main(dbname, model_path):
+    model = attest.topology.compact.load(dbname, model_path)
+    print(NodeBreakerModel(model).topological_nodes)
 
 
 if __name__ == '__main__':
@@ -4,6 +4,27 @@ import typing
 from attest.topology import db
 
 
+projection = {
+    'cim:Breaker': [],
+    'cim:Disconnector': [],
+    'cim:BusbarSection': [],
+    'cim:ACLineSegment': ['cim:ACLineSegment.r',
+                          'cim:ACLineSegment.x',
+                          'cim:ACLineSegment.gch',
+                          'cim:ACLineSegment.bch',
+                          'cim:ACLineSegment.r0',
+                          'cim:ACLineSegment.x0',
+                          'cim:ACLineSegment.g0ch',
+                          'cim:ACLineSegment.b0ch'],
+    'cim:EquivalentInjection': [],
+    'cim:EnergyConsumer': [],
+    'cim:ConnectivityNode': [],
+    'cim:Terminal': ['cim:Terminal.ConductingEquipment',
+                     'cim:Terminal.ConnectivityNode']}
+"""CIM classes loaded by the model, each with the attributes used in topology
+processing"""
+
+
 class UnprocessedModel:
 
     """Model containing initial data structures - node set, asset map, switch
@@ -14,19 +35,23 @@ class UnprocessedModel:
         connection: reference to the topology database connection object
         branch: CIM branch id - if None, latest is used
         commit: CIM commit id - if None, latest is used
-        valid_time: system snapshot time - if None, latest is used"""
+        valid_time: system snapshot time - if None, latest is used
+        full_objects: if set, records contain all of their attributes,
+            otherwise only the attributes listed in :data:`projection`"""
 
     def __init__(self,
                  connection: db.Connection,
                  branch: typing.Optional[int],
                  commit: typing.Optional[int],
-                 valid_time: typing.Optional[datetime]):
+                 valid_time: typing.Optional[datetime],
+                 full_objects: bool = False):
         self._node_set = None
         self._asset_map = None
         self._switch_map = None
         self._terminal_map = None
         self._connectivity_map = None
-        self._load_data_structures(connection, branch, commit, valid_time)
+        self._load_data_structures(connection, branch, commit, valid_time,
+                                   full_objects)
 
     @property
     def node_set(self):
@@ -46,7 +71,6 @@ class UnprocessedModel:
     @property
     def terminal_map(self):
         """Terminal map"""
-        return self._switch_map
         return self._terminal_map
 
     @property
@@ -54,17 +78,14 @@ class UnprocessedModel:
         """Connectivity map"""
         return self._connectivity_map
 
-    def _load_data_structures(self, connection, branch, commit, valid_time):
+    def _load_data_structures(self, connection, branch, commit, valid_time,
+                              full_objects):
         classes = connection.get_classes()
         classes = {row['cimclass']: row['cimclassid'] for row in classes}
-        class_ids = [classes[name] for name in
-                     ('cim:Breaker', 'cim:Disconnector', 'cim:BusbarSection',
-                      'cim:ACLineSegment', 'cim:EquivalentInjection',
-                      'cim:EnergyConsumer', 'cim:ConnectivityNode',
-                      'cim:Terminal')]
-        records = connection.recordat(branch, commit, valid_time,
-                                      cim_class_ids=class_ids)
-        snapshot = connection.snapshot(None, None)
+        class_ids = [classes[name] for name in projection]
+        records = connection.recordat_stream(
+            branch, commit, valid_time, cim_class_ids=class_ids,
+            projection=None if full_objects else projection)
 
         node_set = []
         asset_map = {}
@@ -81,9 +102,7 @@ class UnprocessedModel:
             if record['cimclass'] == 'cim:ConnectivityNode':
                 node_set.append(record)
             elif record['cimclass'] in ('cim:Breaker', 'cim:Disconnector'):
-                switch_map[mrid] = True  # TODO inject real data
-                if mrid in snapshot:
-                    print(snapshot.get(mrid))
+                switch_map[mrid] = True
             elif record['cimclass'] == 'cim:Terminal':
                 element_mrid = str(record['cim:Terminal.ConductingEquipment'])
                 terminal_map.setdefault(element_mrid, [])
@@ -93,6 +112,10 @@ class UnprocessedModel:
                 connectivity_map.setdefault(cn_mrid, [])
                 connectivity_map[cn_mrid].append(mrid)
 
+        snapshot = connection.snapshot(branch, commit, list(switch_map))
+        for mrid, state in snapshot.items():
+            switch_map[mrid] = state == 1
+
         self._node_set = node_set
         self._asset_map = asset_map
         self._switch_map = switch_map